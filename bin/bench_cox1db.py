@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import contextlib
+import subprocess
+
+from cox1db import synth
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+SIZES = {"small": 1, "medium": 10, "large": 100}
+BENCHES = ["gb2cox1", "protid2taxid", "desc2tax", "cox1_tax2krona", "read_otu",
+           "otu2krona", "change_ncbi_seq"]
+
+
+def make_inputs(workdir, size, seed=0):
+
+    '''Generate (once) the synthetic inputs of a size, return their paths'''
+    scale = SIZES[size]
+    outdir = os.path.join(workdir, size)
+    files = {
+        "genbank": os.path.join(outdir, "mitochondrion.gbff.gz"),
+        "prot2taxid": os.path.join(outdir, "prot.accession2taxid.gz"),
+        "gene_describe": os.path.join(outdir, "gene.describe.tsv"),
+        "taxonomy": os.path.join(outdir, "kraken.taxonomy.gz"),
+        "cox1_describe": os.path.join(outdir, "cox1.describe.tsv"),
+        "cox1_taxonomy": os.path.join(outdir, "cox1.taxonomy.tsv.gz"),
+        "otu": os.path.join(outdir, "otu.tsv"),
+        "cds": os.path.join(outdir, "cds.fasta"),
+        "protein_result": os.path.join(outdir, "protein_result.txt"),
+    }
+    if os.path.exists(os.path.join(outdir, "done")):
+        return files
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    LOG.info("Generating the %s inputs in %s" % (size, outdir))
+    species = synth.Species(5000 * scale, seed)
+    synth.write_genbank(files["genbank"], 20 * scale, species, seed)
+    synth.write_accession2taxid(files["prot2taxid"], 100000 * scale, species, seed)
+    synth.write_gene_describe(files["gene_describe"], 2000 * scale, 100000 * scale, seed)
+    synth.write_kraken_taxonomy(files["taxonomy"], species)
+    synth.write_cox1_describe(files["cox1_describe"], 2000 * scale, species, seed)
+    synth.write_cox1_taxonomy(files["cox1_taxonomy"], 13000 * scale, species, seed)
+    synth.write_otu(files["otu"], 200 * scale, 40, species, seed)
+    synth.write_cds(files["cds"], 500 * scale, seed)
+    synth.write_protein_result(files["protein_result"], 500 * scale, species)
+    open(os.path.join(outdir, "done"), "w").close()
+
+    return files
+
+
+def count_lines(file, start=None):
+
+    '''Number of non comment lines, or of lines starting with start'''
+    from cox1db.reader import read_lines
+
+    if start is None:
+        return sum(1 for _ in read_lines(file))
+
+    return sum(1 for i in read_lines(file, comment=None) if i.startswith(start))
+
+
+def prepare_bench(name, files):
+
+    '''Return (function, args, records, input file) of a bench'''
+    if name == "gb2cox1":
+        from gb2cox1 import get_cox1
+        devnull = open(os.devnull, "w")
+        return get_cox1, (files["genbank"], devnull, devnull, devnull), \
+            count_lines(files["genbank"], b"//"), files["genbank"]
+    if name == "protid2taxid":
+        from protid2taxid import protid2taxid
+        return protid2taxid, (files["gene_describe"], files["prot2taxid"], None, None), \
+            count_lines(files["prot2taxid"]), files["prot2taxid"]
+    if name == "desc2tax":
+        from desc2tax import desc2tax
+        return desc2tax, (files["cox1_describe"], files["taxonomy"]), \
+            count_lines(files["cox1_describe"]), files["cox1_describe"]
+    if name == "cox1_tax2krona":
+        from cox1_tax2krona import cox1_tax2krona
+        return cox1_tax2krona, (files["cox1_taxonomy"],), \
+            count_lines(files["cox1_taxonomy"]), files["cox1_taxonomy"]
+    if name == "read_otu":
+        from otu2krona import read_otu
+        return read_otu, (files["otu"],), count_lines(files["otu"]), files["otu"]
+    if name == "otu2krona":
+        from otu2krona import otu2krona
+        return otu2krona, (files["otu"],), count_lines(files["otu"]), files["otu"]
+    if name == "change_ncbi_seq":
+        from change_ncbi_seq import change_ncbi_seq
+        return change_ncbi_seq, (files["cds"], files["protein_result"]), \
+            count_lines(files["cds"], b">"), files["cds"]
+
+    raise ValueError("Unknown benchmark %r" % name)
+
+
+def run_one(name, size, workdir):
+
+    '''Time one bench in this process, return its measures'''
+    files = make_inputs(workdir, size)
+    func, args, records, file = prepare_bench(name, files)
+    rundir = os.path.join(workdir, size, "run.%s" % name)
+    if not os.path.isdir(rundir):
+        os.makedirs(rundir)
+    os.chdir(rundir)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        func(*args)
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {"bench": name, "size": size, "seconds": seconds, "cpu": cpu, "records": records,
+            "bytes": os.path.getsize(file), "peak_rss": peak * 1024,
+            "rss_growth": (peak - before) * 1024}
+
+
+def run_suite(benches, sizes, workdir, repeat=3):
+
+    '''Run each bench in a fresh interpreter (for its own peak memory), keep the fastest run'''
+    r = []
+    for size in sizes:
+        make_inputs(workdir, size)
+        for name in benches:
+            best = None
+            for _ in range(repeat):
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", name,
+                    "--sizes", size, "--workdir", workdir], check=True,
+                    stdout=subprocess.PIPE).stdout
+                result = json.loads(out.decode("utf-8"))
+                if best is None or result["seconds"] < best["seconds"]:
+                    best = result
+            LOG.info("%s %s: %.3fs" % (name, size, best["seconds"]))
+            r.append(best)
+
+    return r
+
+
+def report(results, baseline=None, tolerance=0.2, fo=None):
+
+    '''Print the results, against baseline when given; return the regressions'''
+    fo = fo or sys.stdout
+    base = {(i["bench"], i["size"]): i for i in (baseline or [])}
+    regressions = []
+
+    fo.write("#bench\tsize\trecords\tseconds\tcpu\trecords/s\tMB/s\tpeak_MB\tbaseline_s\tratio\n")
+    for i in results:
+        line = [i["bench"], i["size"], i["records"], "%.3f" % i["seconds"], "%.3f" % i["cpu"],
+                "%.0f" % (i["records"] / i["seconds"]), "%.2f" % (i["bytes"] / i["seconds"] / 1e6),
+                "%.1f" % (i["peak_rss"] / 1e6)]
+        old = base.get((i["bench"], i["size"]))
+        if old:
+            ratio = i["seconds"] / old["seconds"]
+            line += ["%.3f" % old["seconds"], "%.2f" % ratio]
+            if ratio > 1 + tolerance:
+                line[-1] += " SLOWER"
+                regressions.append(i)
+        else:
+            line += ["-", "-"]
+        fo.write("\t".join(str(j) for j in line) + "\n")
+
+    return regressions
+
+
+def bench_cox1db(benches, sizes, workdir, repeat=3, save=None, compare=None, tolerance=0.2):
+
+    baseline = None
+    if compare:
+        with open(compare) as fh:
+            baseline = json.load(fh)["results"]
+
+    results = run_suite(benches, sizes, os.path.abspath(workdir), repeat)
+    regressions = report(results, baseline, tolerance)
+
+    if save:
+        with open(save, "w") as fo:
+            json.dump({"version": __version__, "python": sys.version.split()[0],
+                       "results": results}, fo, indent=2)
+        LOG.info("Saved the results to %s" % save)
+    if regressions:
+        LOG.info("%s benchmarks are more than %.0f%% slower than %s" % (
+            len(regressions), tolerance * 100, compare))
+        return 1
+
+    return 0
+
+
+def add_help_args(parser):
+
+    parser.add_argument("-b", "--benches", nargs="+", metavar="STR", choices=BENCHES, default=BENCHES,
+        help="Benchmarks to run, default all (%s)." % ", ".join(BENCHES))
+    parser.add_argument("-s", "--sizes", nargs="+", metavar="STR", choices=list(SIZES), default=["small"],
+        help="Input sizes (small, medium, large), default=small.")
+    parser.add_argument("-w", "--workdir", metavar="DIR", type=str, default="cox1db.bench",
+        help="Directory of the generated inputs, reused between runs, default=cox1db.bench.")
+    parser.add_argument("-r", "--repeat", metavar="INT", type=int, default=3,
+        help="Runs of each benchmark, the fastest is kept, default=3.")
+    parser.add_argument("--save", metavar="FILE", type=str, default=None,
+        help="Save the results as a json baseline.")
+    parser.add_argument("--compare", metavar="FILE", type=str, default=None,
+        help="Compare against a saved baseline, exit 1 on a regression.")
+    parser.add_argument("--tolerance", metavar="FLOAT", type=float, default=0.2,
+        help="Slowdown against the baseline counted as a regression, default=0.2.")
+    parser.add_argument("--run", metavar="STR", choices=BENCHES, default=None,
+        help=argparse.SUPPRESS)
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     bench_cox1db.py: Time the core function of each script on synthetic inputs.
+
+     Inputs (GenBank records, accession2taxid, kraken taxonomy, describe
+     tables, OTU matrices, cds fasta) are generated offline from a fixed seed
+     and reused. Each benchmark runs in a fresh interpreter; the report gives
+     the records/s, MB/s and peak RSS of the fastest run.
+
+attention:
+     bench_cox1db.py
+     bench_cox1db.py --sizes small medium --save baseline.json
+     bench_cox1db.py --sizes small medium --compare baseline.json --tolerance 0.1
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    if args.run:
+        logging.getLogger().setLevel(logging.WARNING)
+        result = run_one(args.run, args.sizes[0], os.path.abspath(args.workdir))
+        sys.stdout.write(json.dumps(result) + "\n")
+        return 0
+
+    sys.exit(bench_cox1db(args.benches, args.sizes, args.workdir, args.repeat,
+                          args.save, args.compare, args.tolerance))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import time
+import pickle
+import logging
+import argparse
+import collections
+import multiprocessing
+
+from gb2cox1 import read_genbank, get_cox1_tuples
+from protid2taxid import resolve_taxids
+from desc2tax import index_gene_desc, annotate_desc
+from cox1_tax2krona import read_cox1_tax, count_lineages, write_krona
+from cox1db.fasta import read_fasta_blocks
+from cox1db.reader import source_stat, read_tsv
+from cox1db.lineage import LineageTable
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+STAGES = ["extract", "taxid", "taxonomy", "krona"]
+VERSION_LINE = re.compile(br"^VERSION\s+(\S+)", re.M)
+LOCUS_LINE = re.compile(br"^LOCUS\s+(\S+)", re.M)
+
+
+def input_stat(file):
+
+    return dict(source_stat(file), file=os.path.abspath(file))
+
+
+def describe_fields(ncid, taxon, organism, taxonomy):
+
+    '''The fields desc2tax.py reads back from a gb2cox1.py describe line'''
+    return ("%s\t%s\t%s\t%s" % (ncid, taxon, organism, "\t".join(taxonomy))).strip().split("\t")
+
+
+def record_version(record):
+
+    '''Return (accession, version) of a raw GenBank record'''
+    match = VERSION_LINE.search(record) or LOCUS_LINE.search(record)
+    if not match:
+        return "", ""
+    accession = match.group(1).decode("utf-8")
+
+    return accession.split(".")[0], accession
+
+
+def read_releases(files, manifest=None):
+
+    '''Yield (accession, version, sha1, raw record) of the GenBank files
+
+    Records whose version and hash match the manifest are yielded with a
+    None raw record, they need not be extracted again.
+    '''
+    for file in files:
+        for record in read_genbank(file):
+            accession, version = record_version(record)
+            digest = hashlib.sha1(record).hexdigest()
+            if manifest and manifest.get(accession, [None, None])[:2] == [version, digest]:
+                record = None
+            yield accession, version, digest, record
+
+
+def extract_batch(records):
+
+    '''Worker: the iter_cox1 tuples of each raw record, None for None records'''
+    return [get_cox1_tuples([i]) if i is not None else None for i in records]
+
+
+def iter_extract(releases, threads=1, batch=200, inflight=0):
+
+    '''Yield (accession, version, sha1, tuples) of read_releases
+
+    tuples is None for the unchanged records. With threads the records are
+    extracted by batches in worker processes, at most inflight batches are
+    queued and the results keep the input order.
+    '''
+    if threads <= 1:
+        for accession, version, digest, record in releases:
+            yield accession, version, digest, extract_batch([record])[0]
+        return
+
+    pool = multiprocessing.Pool(threads)
+    pending = collections.deque()
+    inflight = inflight or 2 * threads
+    keys, records = [], []
+
+    for accession, version, digest, record in releases:
+        keys.append((accession, version, digest))
+        records.append(record)
+        if len(records) < batch:
+            continue
+        if len(pending) >= inflight:
+            done, result = pending.popleft()
+            for key, tuples in zip(done, result.get()):
+                yield key + (tuples,)
+        pending.append((keys, pool.apply_async(extract_batch, (records,))))
+        keys, records = [], []
+    if records:
+        pending.append((keys, pool.apply_async(extract_batch, (records,))))
+    while pending:
+        done, result = pending.popleft()
+        for key, tuples in zip(done, result.get()):
+            yield key + (tuples,)
+    pool.close()
+    pool.join()
+
+
+def read_manifest(file):
+
+    '''accession -> [version, sha1, protein ids] in file order'''
+    r = collections.OrderedDict()
+
+    for line in read_tsv(file, "\t"):
+        ids = line[3].split(",") if len(line) > 3 and line[3] != "-" else []
+        r[line[0]] = [line[1], line[2], ids]
+
+    return r
+
+
+def write_manifest(manifest, file):
+
+    with gzip.open(file + ".tmp", "wt") as fo:
+        fo.write("#accession\tversion\tsha1\tprotein_ids\n")
+        for accession, (version, digest, ids) in manifest.items():
+            fo.write("%s\t%s\t%s\t%s\n" % (accession, version, digest, ",".join(ids) or "-"))
+    os.replace(file + ".tmp", file)
+
+    return file
+
+
+def write_fasta_entries(tuples, fa, fo):
+
+    for ncid, gene, organism, taxon, taxonomy, seq, protein in tuples:
+        fa.write(">%s|%s [organism=%s] [taxon=%s]\n%s\n" % (ncid, gene, organism, taxon, seq))
+        if protein is not None:
+            fo.write(">%s|%s [organism=%s] [taxon=%s]\n%s\n" % (ncid, gene, organism, taxon, protein))
+
+    return 0
+
+
+class Checkpoint(object):
+
+    '''Completed stages, their timings and saved state in <prefix>.build/'''
+
+    def __init__(self, prefix, inputs, resume=False):
+
+        self.workdir = "%s.build" % prefix
+        self.file = os.path.join(self.workdir, "checkpoint.json")
+        self.inputs = inputs
+        self.stages = collections.OrderedDict()
+
+        if resume and os.path.exists(self.file):
+            with open(self.file) as fh:
+                data = json.load(fh)
+            if data["inputs"] == inputs:
+                self.stages.update((i["name"], i) for i in data["stages"])
+            else:
+                LOG.info("Inputs of %s changed, building from the start" % self.file)
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+
+    def done(self, stage):
+
+        return stage in self.stages
+
+    def state_file(self, stage):
+
+        return os.path.join(self.workdir, "%s.pkl" % stage)
+
+    def load(self, stage):
+
+        with open(self.state_file(stage), "rb") as fh:
+            return pickle.load(fh)
+
+    def save(self, stage, state, seconds, records):
+
+        temp = self.state_file(stage) + ".tmp"
+        with open(temp, "wb") as fh:
+            pickle.dump(state, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.state_file(stage))
+        self.stages[stage] = {"name": stage, "seconds": round(seconds, 3), "records": records}
+        self.write()
+
+    def write(self):
+
+        with open(self.file + ".tmp", "w") as fh:
+            json.dump({"inputs": self.inputs, "stages": list(self.stages.values())}, fh, indent=2)
+        os.replace(self.file + ".tmp", self.file)
+
+    def clean(self):
+
+        for stage in self.stages:
+            if os.path.exists(self.state_file(stage)):
+                os.remove(self.state_file(stage))
+
+
+def run_extract(files, prefix, threads=1, batch=200):
+
+    '''GenBank -> prefix.fasta, prefix.pep.fasta, prefix.manifest.tsv.gz and the describe rows'''
+    rows = []
+    manifest = collections.OrderedDict()
+
+    with open("%s.fasta" % prefix, "w") as fa, open("%s.pep.fasta" % prefix, "w") as fo:
+        for accession, version, digest, tuples in iter_extract(read_releases(files), threads, batch):
+            write_fasta_entries(tuples, fa, fo)
+            manifest[accession] = [version, digest, [i[0] for i in tuples]]
+            rows += [describe_fields(i[0], i[3], i[2], i[4]) for i in tuples]
+    write_manifest(manifest, "%s.manifest.tsv.gz" % prefix)
+
+    return rows
+
+
+def run_taxid(rows, prot2taxid, index=None):
+
+    '''Fill in the tax_id of rows without one from prot.accession2taxid'''
+    data = {}
+    for row in rows:
+        if len(row) > 1 and row[1] not in ("", "-"):
+            continue
+        data[row[0]] = ["-"]
+    if not data:
+        return rows
+
+    remain = resolve_taxids(data, prot2taxid, index)
+    for row in rows:
+        if row[0] not in data or row[0] in remain:
+            continue
+        if len(row) > 1:
+            row[1] = data[row[0]][0]
+        else:
+            row.append(data[row[0]][0])
+    LOG.info("Resolved the taxid of %s/%s proteins" % (len(data)-len(remain), len(data)))
+
+    return rows
+
+
+def run_taxonomy(rows, taxonomy, prefix, cache=None):
+
+    '''Annotate rows, write prefix.taxonomy.tsv.gz and return the lineages'''
+    lineages = []
+
+    with gzip.open("%s.taxonomy.tsv.gz" % prefix, "wt") as fo:
+        fo.write("#protein_id\ttax\ttax_id\torganism\n")
+        for line in annotate_desc(index_gene_desc(rows), taxonomy, cache):
+            fo.write("%s\n" % "\t".join(line))
+            lineages.append(line[1])
+
+    return lineages
+
+
+def run_krona(lineages, prefix):
+
+    table = LineageTable()
+    data = count_lineages(lineages, table)
+    with open("%s.tax2krona.tsv" % prefix, "w") as fo:
+        write_krona(data, table, fo)
+
+    return data
+
+
+def build(files, taxonomy, prefix="cox1", cache=None, prot2taxid=None, index=None,
+          threads=1, batch=200, resume=False):
+
+    inputs = {"genbank": [input_stat(i) for i in files], "taxonomy": input_stat(taxonomy),
+              "prot2taxid": input_stat(prot2taxid) if prot2taxid else None}
+    checkpoint = Checkpoint(prefix, inputs, resume)
+    state = None
+
+    for n, stage in enumerate(STAGES):
+        if checkpoint.done(stage):
+            LOG.info("Stage %s already completed, skipped" % stage)
+            continue
+        if n > 0 and state is None:
+            state = checkpoint.load(STAGES[n-1])
+
+        start = time.time()
+        with stats.stage(stage) as st:
+            if stage == "extract":
+                state = run_extract(files, prefix, threads, batch)
+            elif stage == "taxid":
+                if prot2taxid:
+                    state = run_taxid(state, prot2taxid, index)
+            elif stage == "taxonomy":
+                state = run_taxonomy(state, taxonomy, prefix, cache)
+            else:
+                state = run_krona(state, prefix)
+            st.records = records = len(state) if state is not None else 0
+        seconds = time.time() - start
+        checkpoint.save(stage, state, seconds, records)
+        LOG.info("Stage %s finished in %.2fs (%s records)" % (stage, seconds, records))
+
+    checkpoint.clean()
+    for stage in checkpoint.stages.values():
+        LOG.info("%-10s %10.2fs %10s records" % (stage["name"], stage["seconds"], stage["records"]))
+
+    return 0
+
+
+def patch_fasta(file, stale, text):
+
+    '''Drop the records of the stale protein ids from file and append text'''
+    with open(file + ".tmp", "wb") as fo:
+        if os.path.exists(file):
+            for block in read_fasta_blocks(file):
+                if block.split(b"|", 1)[0].decode("utf-8") in stale:
+                    continue
+                fo.write(b">" + block)
+                if not block.endswith(b"\n"):
+                    fo.write(b"\n")
+        fo.write(text.encode("utf-8"))
+    os.replace(file + ".tmp", file)
+
+    return file
+
+
+def patch_taxonomy(file, stale, lines):
+
+    '''Drop the rows of the stale protein ids from file and append lines'''
+    with gzip.open(file + ".tmp", "wt") as fo:
+        fo.write("#protein_id\ttax\ttax_id\torganism\n")
+        if os.path.exists(file):
+            with gzip.open(file, "rt") as fh:
+                for line in fh:
+                    if line.startswith("#") or line.split("\t", 1)[0] in stale:
+                        continue
+                    fo.write(line)
+        for line in lines:
+            fo.write("%s\n" % "\t".join(line))
+    os.replace(file + ".tmp", file)
+
+    return file
+
+
+def update(files, taxonomy, prefix="cox1", cache=None, prot2taxid=None, index=None,
+           threads=1, batch=200):
+
+    '''Patch the outputs of a previous build with a new GenBank release
+
+    Only the records that are new or whose version or sha1 changed against
+    PREFIX.manifest.tsv.gz are extracted and annotated. The proteins of the
+    changed and withdrawn records are dropped from PREFIX.fasta,
+    PREFIX.pep.fasta and PREFIX.taxonomy.tsv.gz, the new ones appended, and
+    PREFIX.tax2krona.tsv is counted again from the patched taxonomy.
+    '''
+    start = time.time()
+    old = read_manifest("%s.manifest.tsv.gz" % prefix)
+    manifest = collections.OrderedDict()
+    counts = collections.Counter()
+    added = []
+
+    for accession, version, digest, tuples in iter_extract(read_releases(files, old), threads, batch):
+        if tuples is None:
+            manifest[accession] = old[accession]
+            counts["unchanged"] += 1
+            continue
+        counts["changed" if accession in old else "new"] += 1
+        manifest[accession] = [version, digest, [i[0] for i in tuples]]
+        added += tuples
+
+    stale = set(i[0] for i in added)
+    for accession in old:
+        if accession not in manifest:
+            counts["withdrawn"] += 1
+        elif manifest[accession] is old[accession]:
+            continue
+        stale.update(old[accession][2])
+    LOG.info("%s new, %s changed, %s withdrawn and %s unchanged records" % (
+        counts["new"], counts["changed"], counts["withdrawn"], counts["unchanged"]))
+
+    fa, fo = io.StringIO(), io.StringIO()
+    write_fasta_entries(added, fa, fo)
+    patch_fasta("%s.fasta" % prefix, stale, fa.getvalue())
+    patch_fasta("%s.pep.fasta" % prefix, stale, fo.getvalue())
+
+    rows = [describe_fields(i[0], i[3], i[2], i[4]) for i in added]
+    if prot2taxid:
+        rows = run_taxid(rows, prot2taxid, index)
+    lines = list(annotate_desc(index_gene_desc(rows), taxonomy, cache)) if rows else []
+    patch_taxonomy("%s.taxonomy.tsv.gz" % prefix, stale, lines)
+
+    table = LineageTable()
+    data = read_cox1_tax("%s.taxonomy.tsv.gz" % prefix, table)
+    with open("%s.tax2krona.tsv" % prefix, "w") as fh:
+        write_krona(data, table, fh)
+    # written last, an interrupted update is redone from the old manifest
+    write_manifest(manifest, "%s.manifest.tsv.gz" % prefix)
+    LOG.info("Updated %s: %s proteins dropped, %s added in %.2fs" % (
+        prefix, len(stale), len(added), time.time()-start))
+
+    return 0
+
+
+def add_help_args(parser):
+
+    parser.add_argument("genbank", nargs="+", metavar="FILE", type=str,
+        help="Input the mitochondrial genebank file.")
+    parser.add_argument("-tax", "--taxonomy", metavar="FILE", type=str, required=True,
+        help="input taxonomy file(kraken.taxonomy.gz).")
+    parser.add_argument("-c", "--cache", metavar="FILE", type=str, default=None,
+        help="Compiled taxonomy cache, (re)built when missing or older than --taxonomy.")
+    parser.add_argument("-pt", "--prot2taxid", metavar="FILE", type=str, default=None,
+        help="Resolve missing taxids from prot.accession2taxid.gz, skipped by default.")
+    parser.add_argument("-i", "--index", metavar="FILE", type=str, default=None,
+        help="Binary index of --prot2taxid (protid2taxid.py --build-index).")
+    parser.add_argument("-p", "--prefix", metavar="STR", type=str, default="cox1",
+        help="Output prefix, default=cox1.")
+    parser.add_argument("-t", "--threads", metavar="INT", type=int, default=1,
+        help="Number of processes extracting the GenBank records, default=1.")
+    parser.add_argument("--batch", metavar="INT", type=int, default=200,
+        help="Records per batch with --threads, default=200.")
+    parser.add_argument("--resume", action="store_true",
+        help="Resume from the last completed stage of a failed run.")
+    parser.add_argument("--update", action="store_true",
+        help="Only extract the records new or changed since the build of PREFIX.manifest.tsv.gz and patch its outputs.")
+
+    add_stats_args(parser)
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     build_cox1db.py: Build the cox1 database from GenBank files in one process.
+
+     Runs gb2cox1.py, protid2taxid.py, desc2tax.py and cox1_tax2krona.py on the
+     records in memory and writes PREFIX.fasta, PREFIX.pep.fasta,
+     PREFIX.taxonomy.tsv.gz and PREFIX.tax2krona.tsv. The completed stages are
+     recorded in PREFIX.build/ so that --resume restarts after the last one.
+     PREFIX.manifest.tsv.gz lists the version and sha1 of each GenBank record,
+     --update uses it to patch the outputs with a new release.
+
+attention:
+     build_cox1db.py mitochondrion.*.gbff.gz --taxonomy kraken.taxonomy.gz
+     build_cox1db.py mitochondrion.*.gbff.gz --taxonomy kraken.taxonomy.gz --cache kraken.taxonomy.cache --threads 8
+     build_cox1db.py mitochondrion.*.gbff.gz --taxonomy kraken.taxonomy.gz --resume
+     build_cox1db.py new_release/mitochondrion.*.gbff.gz --taxonomy kraken.taxonomy.gz --update
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    with instrument(args):
+        if args.update:
+            update(args.genbank, args.taxonomy, args.prefix, args.cache, args.prot2taxid,
+                   args.index, args.threads, args.batch)
+            return 0
+
+        build(args.genbank, args.taxonomy, args.prefix, args.cache, args.prot2taxid,
+              args.index, args.threads, args.batch, args.resume)
+
+
+if __name__ == "__main__":
+
+    main()
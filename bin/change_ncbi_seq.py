@@ -3,13 +3,15 @@
 
 import os
 import sys
-import gzip
 import logging
 import argparse
-import collections
-
-from Bio import SeqIO
 
+from cox1db.reader import source_stat, read_lines
+from cox1db.fasta import read_fasta, split_attr, FastaIndex
+from cox1db.kvindex import build_kv, KVIndex
+from cox1db.writer import open_output, output_name, output_compress, add_output_args
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
 
 LOG = logging.getLogger(__name__)
 
@@ -19,102 +21,132 @@ __email__ = "invicoun@foxmail.com"
 __all__ = []
 
 
+def read_protein_pairs(file):
+
+    '''Yield (protein_id, organism) as bytes in protein_result.txt order'''
+    organism = b""
+    for line in read_lines(file, comment=None):
+        i = line.find(b"[")
+        if i >= 0:
+            organism = line[i+1:].strip(b"]")
+        if line.find(b"GI:") >= 0:
+            yield line.split()[0], organism
+
+
 def read_protein_result(file):
 
     r = {}
-    organism = ""
-    protein_id = ""
-    for line in open(file):
-        line = line.strip()
-
-        if not line:
-            continue
-        if "[" in line:
-            organism = line.split("[", 1)[1].strip("]")
-        if "GI:" in line:
-            protein_id = line.split()[0]
-            r[protein_id] = organism
+    for protein_id, organism in read_protein_pairs(file):
+        r[protein_id.decode("utf-8")] = organism.decode("utf-8")
 
     return r
 
 
-def read_fasta(file):
+class SortedJoin(object):
 
-    '''Read fasta file'''
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    else:
-        fp = open(file)
-
-    seq = []
-    for line in fp:
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
-        line = line.strip()
-
-        if not line:
-            continue
-        if line.startswith(">"):
-            line = line.strip(">")
-            if len(seq) == 2:
-                yield seq
-            seq = []
-            seq.append(line)
-            continue
-        if len(seq) == 2:
-            seq[1] += line
-        else:
-            seq.append(line)
-
-    if len(seq) == 2:
-        yield seq
-    fp.close()
-
-
-def split_attr(attributes):
-
-    r = collections.OrderedDict()
-    contents = attributes.strip("[").strip("]").split("] [")
-
-    for content in contents:
-        content = content
-        if not content:
-            continue
-        if "=" not in content:
-            print("%r is not a good formated attribute: no tag!")
-            continue
-        tag, value = content.split("=", 1)
-        r[tag] = value
+    '''Look up protein ids in increasing order against a sorted pair stream'''
 
-    return r
+    def __init__(self, pairs):
+
+        self.pairs = iter(pairs)
+        self.pair = next(self.pairs, None)
+        self.key = None
+        self.value = None
+
+    def advance(self):
+
+        last = self.pair[0]
+        self.pair = next(self.pairs, None)
+        if self.pair is not None and self.pair[0] < last:
+            raise ValueError("protein_result is not sorted by protein_id: %r after %r" % (self.pair[0], last))
+
+    def get(self, key):
+
+        if key == self.key:
+            return self.value
+        if self.key is not None and key < self.key:
+            raise ValueError("Sequences are not sorted by protein_id: %r after %r" % (key, self.key))
+        self.key = key
+        self.value = None
+        while self.pair is not None and self.pair[0] < key:
+            self.advance()
+        while self.pair is not None and self.pair[0] == key:
+            self.value = self.pair[1]
+            self.advance()
 
+        return self.value
 
-def change_ncbi_seq(file, presult):
 
-    data = read_protein_result(presult)
+def open_protein_result(presult, join="dict", db=None):
 
-    fo = open("gene.describe.tsv", "w")
+    '''Return a protein_id -> organism lookup with a get method
+
+    join="dict" loads protein_result.txt into memory, "db" uses an on-disk
+    index (rebuilt when missing or stale) and "sorted" merge-joins with
+    inputs sorted by protein_id (LC_ALL=C sort order).
+    '''
+    if join == "dict":
+        return read_protein_result(presult)
+    if join == "sorted":
+        return SortedJoin((k.decode("utf-8"), v.decode("utf-8")) for k, v in read_protein_pairs(presult))
+
+    db = db or "%s.kv" % presult
+    if os.path.exists(db):
+        r = KVIndex(db, "utf-8")
+        if not r.is_stale(presult):
+            return r
+        r.close()
+    build_kv(read_protein_pairs(presult), db, source_stat(presult))
+
+    return KVIndex(db, "utf-8")
+
+
+def change_ncbi_seq(file, presult, index=False, join="dict", db=None, output="-", compress=None,
+                    describe="gene.describe.tsv"):
+
+    with stats.stage("load_presult", nbytes=os.path.getsize(presult)):
+        data = open_protein_result(presult, join, db)
+    stats.size("protein_result", data if join == "dict" else 0)
+
+    if index:
+        fasta = FastaIndex(file)
+    else:
+        fasta = read_fasta(file)
+
+    compress = output_compress(output, compress)
+    fa = open_output(output, compress)
+    fo = open_output(output_name(describe, compress), compress)
     fo.write("#protein_id\ttax_id\torganism\n")
-    for seqid, seq in read_fasta(file):
-        seqid, attribute = seqid.split(" ", 1)
-        attribute = split_attr(attribute)
-        protein_id = attribute["protein_id"]
-
-        if "gene" in  attribute:
-            gene = attribute["gene"]
-        elif "protein" in  attribute:
-            gene = attribute["protein"]
-        else:
-            gene = ""
-
-        if protein_id in data:
-            print(">%s|%s [organism=%s]\n%s" % (protein_id, gene.upper(), data[protein_id], seq))
-            fo.write("%s\t-\t%s\n" % (protein_id, data[protein_id]))
-        else:
-            print(">%s|%s/n%s" % (protein_id, gene.upper(), seq))
-            fo.write("%s\t-\t-\n" % (protein_id))
+    n = 0
+    with stats.stage("convert", nbytes=os.path.getsize(file)) as st:
+        for seqid, seq in fasta:
+            n += 1
+            seqid, attribute = seqid.split(" ", 1)
+            attribute = split_attr(attribute)
+            protein_id = attribute["protein_id"]
+
+            if "gene" in  attribute:
+                gene = attribute["gene"]
+            elif "protein" in  attribute:
+                gene = attribute["protein"]
+            else:
+                gene = ""
+
+            organism = data.get(protein_id)
+            if organism is not None:
+                fa.write(">%s|%s [organism=%s]\n%s\n" % (protein_id, gene.upper(), organism, seq))
+                fo.write("%s\t-\t%s\n" % (protein_id, organism))
+            else:
+                fa.write(">%s|%s/n%s\n" % (protein_id, gene.upper(), seq))
+                fo.write("%s\t-\t-\n" % (protein_id))
+        st.records = n
 
     fo.close()
+    fa.close()
+    if index:
+        fasta.close()
+    if join == "db":
+        data.close()
     return 0
 
 
@@ -124,6 +156,15 @@ def add_help_args(parser):
         help="Input the downloaded CDS sequence.")
     parser.add_argument("-pr", "--presult", metavar="FILE", type=str, required=True,
         help="Input protein sequence description file(protein_result.txt).")
+    parser.add_argument("--index", action="store_true",
+        help="Read the (uncompressed) input through a .fai index, one record in memory at a time.")
+    parser.add_argument("-j", "--join", choices=["dict", "db", "sorted"], default="dict",
+        help="Join with protein_result: in memory (dict), on-disk index (db) or merge of inputs sorted by protein_id (sorted), default=dict.")
+    parser.add_argument("--db", metavar="FILE", type=str, default=None,
+        help="On-disk index of --presult for --join db, default=PRESULT.kv.")
+
+    add_output_args(parser)
+    add_stats_args(parser)
 
     return parser
 
@@ -144,6 +185,8 @@ name:
 
 attention:
      change_ncbi_seq.py all.cox1.fa -pr protein_result.txt >all.new_cox1.fa
+     change_ncbi_seq.py all.cox1.fa -pr protein_result.txt --index --join db >all.new_cox1.fa
+     change_ncbi_seq.py all.cox1.fa -pr protein_result.txt -o all.new_cox1.fa.gz
 
 version: %s
 contact:  %s <%s>\
@@ -151,7 +194,9 @@ contact:  %s <%s>\
 
     args = add_help_args(parser).parse_args()
 
-    change_ncbi_seq(args.input, args.presult)
+    with instrument(args):
+        change_ncbi_seq(args.input, args.presult, args.index, args.join, args.db,
+                        args.output, args.compress)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import logging
+import argparse
+import importlib
+import subprocess
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+# command: (script module, heavy modules its import may load, summary)
+COMMANDS = {
+    "gb2cox1": ("gb2cox1", [], "Extract the cox1 genes of GenBank files."),
+    "protid2taxid": ("protid2taxid", [], "Fill the taxids of gene.describe.tsv from prot.accession2taxid."),
+    "desc2tax": ("desc2tax", [], "Add the taxonomy to cox1.describe.tsv."),
+    "tax2krona": ("cox1_tax2krona", [], "Count the proteins of each lineage for krona."),
+    "otu2krona": ("otu2krona", ["numpy"], "Split an OTU table into one krona file per sample."),
+    "change_ncbi_seq": ("change_ncbi_seq", [], "Rename NCBI cds sequences by protein id and organism."),
+    "build": ("build_cox1db", [], "Build or update the cox1 database from GenBank releases."),
+    "dedup": ("dedup_cox1", [], "Collapse identical cox1 sequences."),
+    "tax2columns": ("tax2columns", ["numpy"], "Convert cox1 taxonomy tables to the columnar form."),
+    "classify": ("cox1_classify", ["numpy"], "Assign reads to taxa with a k-mer index of the cox1 sequences."),
+    "lca": ("cox1_lca", ["numpy"], "Lowest common ancestor of the lineages of groups of protein ids."),
+    "server": ("cox1_server", [], "Serve cox1 taxonomy lookups from memory on a Unix socket."),
+    "bench": ("bench_cox1db", [], "Time the scripts on synthetic inputs."),
+}
+HEAVY = ["Bio", "numpy"]
+
+
+def run_command(command, argv):
+
+    '''Import the script of command only now and run its main with argv'''
+    module = importlib.import_module(COMMANDS[command][0])
+    sys.argv = ["cox1.py %s" % command] + list(argv)
+
+    return module.main()
+
+
+def import_time(module, repeat=3):
+
+    '''Return (fastest import time in seconds, {top level module: seconds}) of module in a fresh interpreter'''
+    best = None
+    loaded = {}
+
+    for _ in range(repeat):
+        err = subprocess.run([sys.executable, "-X", "importtime", "-c",
+            "import sys; sys.path.insert(0, %r); import %s" % (BIN, module)],
+            check=True, stderr=subprocess.PIPE).stderr.decode("utf-8")
+        seconds = 0
+        for line in err.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            fields = line.split("|")
+            if not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            top = name.split(".")[0]
+            if name == top:
+                loaded[top] = max(loaded.get(top, 0), int(fields[1]) / 1e6)
+            if name == module:
+                seconds = int(fields[1]) / 1e6
+        if best is None or seconds < best:
+            best = seconds
+
+    return best, loaded
+
+
+def check_imports(commands, budget=0.2, repeat=3, fo=None):
+
+    '''Report the import time of each command, return the number over budget or loading a heavy module
+
+    The heavy modules a command needs are not counted in its budget.
+    '''
+    fo = fo or sys.stdout
+    failed = 0
+
+    fo.write("#command\tmodule\timport_ms\theavy\tstatus\n")
+    for command in commands:
+        module, allowed, _ = COMMANDS[command]
+        seconds, loaded = import_time(module, repeat)
+        heavy = [i for i in HEAVY if i in loaded and i not in allowed]
+        status = "ok"
+        if heavy or seconds - sum(loaded.get(i, 0) for i in allowed) > budget:
+            status = "FAIL"
+            failed += 1
+        fo.write("%s\t%s\t%.1f\t%s\t%s\n" % (command, module, seconds * 1000,
+                 ",".join(heavy) or "-", status))
+
+    return failed
+
+
+def add_help_args(parser):
+
+    parser.add_argument("command", nargs="?", metavar="COMMAND", type=str, default=None,
+        help="Command to run (%s)." % ", ".join(COMMANDS))
+    parser.add_argument("args", nargs=argparse.REMAINDER, metavar="ARGS",
+        help="Arguments of the command, see cox1.py COMMAND -h.")
+    parser.add_argument("--check-imports", action="store_true",
+        help="Time the import of each command in a fresh interpreter, exit 1 when one is over "
+             "--budget (not counting the Biopython/NumPy it needs) or loads them without needing them.")
+    parser.add_argument("--budget", metavar="FLOAT", type=float, default=0.2,
+        help="Import time budget of a command in seconds, default=0.2.")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     cox1.py: Single entry point of the cox1 database scripts.
+
+     The script of a command is only imported when it runs, and Biopython
+     and NumPy are only imported on the code paths that use them.
+
+commands:
+%s
+
+attention:
+     cox1.py gb2cox1 mitochondrion.1.genomic.gbff.gz -t 4
+     cox1.py desc2tax cox1.describe.tsv -tax kraken.taxonomy.gz >cox1.taxonomy.tsv
+     cox1.py build mitochondrion.*.genomic.gbff.gz -tax kraken.taxonomy.gz -p cox1
+     cox1.py --check-imports --budget 0.2
+
+version: %s
+contact:  %s <%s>\
+    """ % ("\n".join("     %-16s%s" % (i, j[2]) for i, j in COMMANDS.items()),
+           __version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    if args.check_imports:
+        commands = [args.command] if args.command else list(COMMANDS)
+        sys.exit(1 if check_imports(commands, args.budget) else 0)
+    if args.command not in COMMANDS:
+        parser.error("choose a command from %s" % ", ".join(COMMANDS))
+
+    return run_command(args.command, args.args)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import logging
+import argparse
+import collections
+import multiprocessing
+
+import numpy as np
+
+from cox1db.fasta import read_reads
+from cox1db.lca import NONE, group_lca
+from cox1db.kmerindex import seq_kmers, build_kmer_index, KmerIndex
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+UNCLASSIFIED = "k__unclassified"
+SUFFIX = re.compile(r"(\.(fastq|fq|fasta|fa|fna))?(\.gz)?$")
+WORKER = {}
+
+
+def init_worker(index, min_hits=1, consensus=1.0):
+
+    WORKER["index"] = KmerIndex(index)
+    WORKER["min_hits"] = max(min_hits, 1)
+    WORKER["consensus"] = consensus
+    WORKER["lineages"] = {}
+
+
+def classify_batch(reads):
+
+    '''Worker: [name, lineage ("" when unclassified), k-mer hits, k-mers] of each read'''
+    idx = WORKER["index"]
+    cache = WORKER["lineages"]
+    kmers = [seq_kmers(seq, idx.k, idx.window) for _, seq in reads]
+    total = np.array([len(i) for i in kmers], dtype=np.int64)
+    nodes = idx.lookup(np.concatenate(kmers)) if len(reads) else np.zeros(0, dtype=np.uint32)
+
+    hit = nodes != NONE
+    read = np.repeat(np.arange(len(reads)), total)[hit]
+    nodes = nodes[hit]
+    hits = np.bincount(read, minlength=len(reads))
+    ok = hits >= WORKER["min_hits"]
+    lineages = [""] * len(reads)
+    if ok.any():
+        lca = group_lca(idx.node_ranks[nodes[ok[read]]], hits[ok], 0, WORKER["consensus"])
+        for i, row in zip(np.flatnonzero(ok).tolist(), map(tuple, lca.tolist())):
+            if row not in cache:
+                cache[row] = idx.lineage(row)
+            lineages[i] = cache[row]
+
+    return [[name.decode("utf-8"), tax, h, t] for (name, _), tax, h, t in zip(
+        reads, lineages, hits.tolist(), total.tolist())]
+
+
+def read_batches(file, batch):
+
+    r = []
+    for name, seq in read_reads(file, encoding=None):
+        r.append((name.split()[0], seq))
+        if len(r) >= batch:
+            yield r
+            r = []
+    if r:
+        yield r
+
+
+def iter_classify(file, index, threads=1, batch=5000, min_hits=1, consensus=1.0):
+
+    '''Yield the classify_batch results of the reads of file, in file order'''
+    if threads <= 1:
+        init_worker(index, min_hits, consensus)
+        for reads in read_batches(file, batch):
+            yield classify_batch(reads)
+        return
+
+    pool = multiprocessing.Pool(threads, init_worker, (index, min_hits, consensus))
+    pending = collections.deque()
+    for reads in read_batches(file, batch):
+        if len(pending) >= 2 * threads:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(classify_batch, (reads,)))
+    while pending:
+        yield pending.popleft().get()
+    pool.close()
+    pool.join()
+
+
+def sample_name(file):
+
+    return SUFFIX.sub("", os.path.basename(file))
+
+
+def cox1_classify(files, index, prefix="cox1.classify", threads=1, batch=5000, min_hits=1,
+                  consensus=1.0):
+
+    samples = [sample_name(i) for i in files]
+    counts = collections.OrderedDict()
+    fo = open("%s.reads.tsv" % prefix, "w")
+    fo.write("#read\tsample\ttax\thits\tkmers\n")
+
+    for n, (file, sample) in enumerate(zip(files, samples)):
+        reads = classified = 0
+        with stats.stage("classify", nbytes=os.path.getsize(file)) as st:
+            for result in iter_classify(file, index, threads, batch, min_hits, consensus):
+                for name, tax, hits, kmers in result:
+                    reads += 1
+                    if tax:
+                        classified += 1
+                    tax = tax or UNCLASSIFIED
+                    if tax not in counts:
+                        counts[tax] = [0] * len(files)
+                    counts[tax][n] += 1
+                    fo.write("%s\t%s\t%s\t%s\t%s\n" % (name, sample, tax, hits, kmers))
+            st.records = reads
+        LOG.info("%s: classified %s of %s reads" % (sample, classified, reads))
+    fo.close()
+
+    with open("%s.otu_tax.tsv" % prefix, "w") as fo:
+        fo.write("#OTU ID\t%s\n" % "\t".join(samples))
+        for tax, values in counts.items():
+            fo.write("%s\t%s\n" % (tax, "\t".join(str(i) for i in values)))
+    LOG.info("Wrote %s lineages to %s.otu_tax.tsv" % (len(counts), prefix))
+
+    return 0
+
+
+def add_help_args(parser):
+
+    parser.add_argument("input", nargs="*", metavar="FILE", type=str,
+        help="Input reads (fasta or fastq, plain or gzip), one sample per file.")
+    parser.add_argument("-i", "--index", metavar="FILE", type=str, required=True,
+        help="k-mer index built by --build.")
+    parser.add_argument("-p", "--prefix", metavar="STR", type=str, default="cox1.classify",
+        help="Output prefix, default=cox1.classify.")
+    parser.add_argument("-t", "--threads", metavar="INT", type=int, default=1,
+        help="Worker processes, default=1.")
+    parser.add_argument("--batch", metavar="INT", type=int, default=5000,
+        help="Reads sent to a worker at a time, default=5000.")
+    parser.add_argument("--min-hits", metavar="INT", type=int, default=1,
+        help="Index k-mers a read needs to be classified, default=1.")
+    parser.add_argument("--consensus", metavar="FLOAT", type=float, default=1.0,
+        help="Assign a read to the deepest lineage of at least this fraction (>0.5) of its hits, default=1 (LCA).")
+    parser.add_argument("--build", action="store_true",
+        help="Build the index from --fasta and --taxonomy and exit.")
+    parser.add_argument("-f", "--fasta", metavar="FILE", type=str, default=None,
+        help="cox1 nucleotide sequences of gb2cox1.py (cox1.fasta), for --build.")
+    parser.add_argument("-tax", "--taxonomy", metavar="FILE", type=str, default=None,
+        help="cox1.taxonomy.tsv.gz, for --build.")
+    parser.add_argument("-k", "--kmer", metavar="INT", type=int, default=31,
+        help="k-mer length (at most 31), for --build, default=31.")
+    parser.add_argument("-w", "--window", metavar="INT", type=int, default=0,
+        help="Keep only the minimizer of each window of k-mers (0 for all k-mers), for --build, default=0.")
+
+    add_stats_args(parser)
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     cox1_classify.py: Assign reads to taxa with a k-mer index of the cox1 database.
+
+     --build maps the canonical k-mers (or minimizers) of the cox1 sequences
+     to the lowest common ancestor of the lineages holding them, in a
+     memory-mapped index. Each read gets the lowest common ancestor of its
+     k-mer hits (or of a --consensus fraction of them). Writes PREFIX.reads.tsv and the abundance table
+     PREFIX.otu_tax.tsv, the input of otu2krona.py.
+
+attention:
+     cox1_classify.py --build -i cox1.kmer.idx -f cox1.fasta -tax cox1.taxonomy.tsv.gz
+     cox1_classify.py --build -i cox1.kmer.idx -f cox1.fasta -tax cox1.taxonomy.tsv.gz -k 25 -w 8
+     cox1_classify.py S1.fq.gz S2.fq.gz -i cox1.kmer.idx -t 8 -p meta
+     otu2krona.py meta.otu_tax.tsv
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    with instrument(args):
+        if args.build:
+            if not args.fasta or not args.taxonomy:
+                parser.error("--build needs --fasta and --taxonomy")
+            with stats.stage("build", nbytes=os.path.getsize(args.fasta)):
+                build_kmer_index(args.fasta, args.taxonomy, args.index, args.kmer, args.window)
+            return 0
+        if not args.input:
+            parser.error("the following arguments are required: FILE")
+
+        cox1_classify(args.input, args.index, args.prefix, args.threads, args.batch, args.min_hits,
+                      args.consensus)
+
+
+if __name__ == "__main__":
+
+    main()
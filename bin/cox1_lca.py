@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import logging
+import argparse
+
+import numpy as np
+
+from cox1db.reader import read_tsv
+from cox1db.lca import read_lineages, encode_lineages, decode_lineages, group_lca
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+
+def read_groups(file):
+
+    '''Return the groups in first-seen order, the group number and the protein id of each row'''
+    index = {}
+    groups = []
+    protids = []
+
+    for line in read_tsv(file, "\t", fields=[0, 1]):
+        groups.append(index.setdefault(line[0], len(index)))
+        protids.append(line[1])
+
+    return list(index), np.array(groups, dtype=np.int64), protids
+
+
+def read_rank_codes(taxonomy, columns=None):
+
+    '''Return protein_id -> lineage number, the rank codes of the lineages and the rank names'''
+    if columns:
+        from cox1db.columnar import load_cox1_taxonomy
+
+        cols = load_cox1_taxonomy(taxonomy, columns)
+        lineage = cols.lineage.tolist()
+        protids = {j: lineage[i] for i, j in enumerate(cols.protein_id.tolist())}
+        return protids, np.asarray(cols["ranks"]), cols["rank_names"].tolist()
+
+    index = {}
+    protids = {}
+    for protid, tax in read_lineages(taxonomy).items():
+        protids[protid] = index.setdefault(tax, len(index))
+    rows, names = encode_lineages(list(index))
+
+    return protids, rows, list(names)
+
+
+def cox1_lca(file, taxonomy, columns=None, consensus=1.0, fo=None):
+
+    fo = fo or sys.stdout
+    with stats.stage("read_groups", nbytes=os.path.getsize(file)) as st:
+        names, groups, protids = read_groups(file)
+        st.records = len(protids)
+    with stats.stage("read_taxonomy", nbytes=os.path.getsize(taxonomy)) as st:
+        lineages, rows, rank_names = read_rank_codes(taxonomy, columns)
+        st.records = len(lineages)
+    stats.size("lineages", rows)
+
+    with stats.stage("lca", records=len(protids)):
+        codes = np.array([lineages.get(i, -1) for i in protids], dtype=np.int64)
+        found = codes >= 0
+        order = np.argsort(groups[found], kind="stable")
+        counts = np.bincount(groups[found], minlength=len(names))
+        total = np.bincount(groups, minlength=len(names))
+        unclassified = rank_names.index("unclassified") if "unclassified" in rank_names else None
+        lca = group_lca(rows[codes[found][order]], counts[counts > 0], unclassified, consensus)
+        taxa = iter(decode_lineages(lca, rank_names))
+
+    fo.write("#group\ttax\tfound\tproteins\n")
+    for name, n, m in zip(names, counts.tolist(), total.tolist()):
+        fo.write("%s\t%s\t%s\t%s\n" % (name, (next(taxa) or "-") if n else "-", n, m))
+    LOG.info("%s groups, %s of %s protein ids have a lineage" % (
+        len(names), int(found.sum()), len(protids)))
+
+    return 0
+
+
+def add_help_args(parser):
+
+    parser.add_argument("input", metavar="FILE", type=str,
+        help="Input group and protein id table (group<TAB>protein_id, a row per member).")
+    parser.add_argument("-tax", "--taxonomy", metavar="FILE", type=str, required=True,
+        help="cox1.taxonomy.tsv.gz, the lineage of each protein id.")
+    parser.add_argument("-c", "--columns", metavar="FILE", type=str, default=None,
+        help="Columnar form of --taxonomy (tax2columns.py), converted when missing or older.")
+    parser.add_argument("--consensus", metavar="FLOAT", type=float, default=1.0,
+        help="Deepest lineage of at least this fraction (>0.5) of the members, default=1 (LCA).")
+
+    add_stats_args(parser)
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     cox1_lca.py: Lowest common ancestor of the lineages of groups of protein ids.
+
+     Lineages are encoded as rows of k..s rank codes and the LCA of every
+     group is computed at once. With --consensus the group gets the deepest
+     lineage shared by at least that fraction of its members instead.
+     Output: group, lineage ("-" when none), members with a lineage, members.
+
+attention:
+     cox1_lca.py read2protein.tsv -tax cox1.taxonomy.tsv.gz >read.lca.tsv
+     cox1_lca.py read2protein.tsv -tax cox1.taxonomy.tsv.gz -c cox1.taxonomy.tsv.gz.col --consensus 0.8
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    with instrument(args):
+        cox1_lca(args.input, args.taxonomy, args.columns, args.consensus)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import signal
+import logging
+import argparse
+import threading
+import socketserver
+import multiprocessing
+
+from cox1db.reader import source_stat, read_tsv
+from cox1db.taxcache import load_taxonomy
+from cox1db.client import LookupClient
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+
+
+class Database(object):
+
+    '''The lookup tables of the service, read once and never changed
+
+    A reload builds a new Database and swaps it in; requests already
+    running keep the old one until they return.
+    '''
+
+    def __init__(self, taxonomy=None, kraken=None, cache=None, prot2taxid=None, index=None):
+
+        self.files = {"taxonomy": taxonomy, "kraken": kraken, "prot2taxid": prot2taxid, "index": index}
+        self.stats = {i: source_stat(i) for i in self.files.values() if i and os.path.exists(i)}
+        self.loaded = time.time()
+        self.proteins = {}
+        self.lineages = []
+        self.counts = []
+        self.taxids = {}
+        self.kraken = None
+        self.accessions = None
+        self.users = 0
+        self.retired = False
+
+        if taxonomy:
+            self.read_cox1_taxonomy(taxonomy)
+        self.sorted = sorted(range(len(self.lineages)), key=lambda i: self.lineages[i])
+        self.keys = [self.lineages[i] for i in self.sorted]
+        if kraken:
+            self.kraken = load_taxonomy(kraken, cache)
+        if prot2taxid:
+            self.accessions = self.load_index(prot2taxid, index)
+        LOG.info("Loaded %s proteins, %s lineages in %.1fs" % (
+            len(self.proteins), len(self.lineages), time.time() - self.loaded))
+
+    def load_index(self, prot2taxid, index):
+
+        '''Open the accession2taxid index, (re)building it when missing or stale'''
+        from protid2taxid import build_index, AccessionIndex
+
+        if os.path.exists(index):
+            try:
+                return AccessionIndex(index, prot2taxid)
+            except ValueError as e:
+                LOG.info(e)
+        build_index(prot2taxid, index)
+        self.stats[index] = source_stat(index)
+
+        return AccessionIndex(index, prot2taxid)
+
+    def read_cox1_taxonomy(self, file):
+
+        index = {}
+
+        for line in read_tsv(file, "\t", comment=None, fields=[0, 1, 2, 3]):
+            if "#" in line[0]:
+                continue
+            lid = index.get(line[1])
+            if lid is None:
+                lid = index[line[1]] = len(self.lineages)
+                self.lineages.append(line[1])
+                self.counts.append(0)
+            self.counts[lid] += 1
+            self.proteins[line[0]] = (lid, line[2], line[3])
+            if line[2] not in self.taxids:
+                self.taxids[line[2]] = lid
+
+    def is_stale(self):
+
+        for file in self.files.values():
+            if not file or not os.path.exists(file):
+                continue
+            if self.stats.get(file) != source_stat(file):
+                return True
+
+        return False
+
+    def protein(self, keys):
+
+        r = []
+        for i in keys:
+            value = self.proteins.get(i)
+            r.append([self.lineages[value[0]], value[1], value[2]] if value else None)
+
+        return r
+
+    def taxid(self, keys):
+
+        r = []
+        for i in keys:
+            i = str(i)
+            tax = self.kraken.get(i) if self.kraken else None
+            if tax is None and i in self.taxids:
+                tax = self.lineages[self.taxids[i]]
+            r.append(tax)
+
+        return r
+
+    def select(self, keys):
+
+        if self.kraken is None:
+            raise ValueError("no kraken taxonomy loaded")
+
+        return [[taxid, tax] for taxid, tax in self.kraken.select([str(i) for i in keys]).items()]
+
+    def accession(self, keys):
+
+        if self.accessions is None:
+            raise ValueError("no accession2taxid index loaded")
+
+        return [self.accessions.get(i) for i in keys]
+
+    def prefix(self, keys):
+
+        r = []
+        for i in keys:
+            hits = []
+            for j in range(bisect.bisect_left(self.keys, i), len(self.keys)):
+                if not self.keys[j].startswith(i):
+                    break
+                lid = self.sorted[j]
+                hits.append([self.lineages[lid], self.counts[lid]])
+            r.append(hits)
+
+        return r
+
+    def close(self):
+
+        if self.kraken is not None:
+            self.kraken.close()
+            self.kraken = None
+        if self.accessions is not None:
+            self.accessions.close()
+            self.accessions = None
+
+    def info(self):
+
+        return {"files": self.files, "loaded": self.loaded, "proteins": len(self.proteins),
+                "lineages": len(self.lineages), "kraken": self.kraken is not None,
+                "accessions": self.accessions is not None}
+
+
+class LookupHandler(socketserver.StreamRequestHandler):
+
+    '''Answer the json requests of one connection until it is closed'''
+
+    def handle(self):
+
+        service = self.server.service
+        for line in self.rfile:
+            op = None
+            db = service.acquire()
+            try:
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    op = request["op"]
+                    r = {"result": service.answer(db, op, request.get("keys"))}
+                except Exception as e:
+                    r = {"error": str(e)}
+                self.wfile.write(json.dumps(r).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            finally:
+                service.release(db)
+            if op == "shutdown":
+                # only once the reply is out, the handler threads are daemons
+                service.stop()
+                break
+
+
+class LookupServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class LookupService(object):
+
+    def __init__(self, address, interval=5, **sources):
+
+        self.address = address
+        self.interval = interval
+        self.sources = {i: os.path.abspath(j) if j else j for i, j in sources.items()}
+        self.db = Database(**self.sources)
+        self.lock = threading.Condition()
+        self.loading = threading.Lock()
+        self.stopped = threading.Event()
+        self.requests = 0
+        self.active = 0
+
+    def acquire(self):
+
+        '''Count a request and return the Database it runs against'''
+        with self.lock:
+            self.requests += 1
+            self.active += 1
+            db = self.db
+            db.users += 1
+
+        return db
+
+    def release(self, db):
+
+        '''End a request, close db when it was swapped out and this was its last user'''
+        with self.lock:
+            self.active -= 1
+            db.users -= 1
+            close = db.retired and db.users == 0
+            self.lock.notify_all()
+        if close:
+            db.close()
+
+    def answer(self, db, op, keys=None):
+
+        if op in ("protein", "taxid", "accession", "prefix", "select"):
+            return getattr(db, op)(keys or [])
+        if op == "counts":
+            return [[tax, count] for tax, count in zip(db.lineages, db.counts)]
+        if op == "info":
+            return dict(db.info(), requests=self.requests)
+        if op == "reload":
+            return self.reload()
+        if op == "shutdown":
+            return True
+
+        raise ValueError("unknown op %r" % op)
+
+    def reload(self):
+
+        '''Load the sources again and swap the tables in, keep the old ones on error
+
+        The old tables are closed once the requests running on them return.
+        '''
+        with self.loading:
+            try:
+                db = Database(**self.sources)
+            except Exception as e:
+                LOG.error("Reload failed, still serving the tables of %s: %s" % (
+                    time.ctime(self.db.loaded), e))
+                return False
+            with self.lock:
+                old, self.db = self.db, db
+                old.retired = True
+                close = old.users == 0
+            if close:
+                old.close()
+
+        return True
+
+    def stop(self):
+
+        threading.Thread(target=self.server.shutdown).start()
+
+    def watch(self):
+
+        while not self.stopped.wait(self.interval):
+            if self.db.is_stale():
+                LOG.info("The database files changed, reloading")
+                self.reload()
+
+    def serve(self):
+
+        if os.path.exists(self.address):
+            try:
+                LookupClient(self.address).close()
+            except ValueError:
+                # left behind by a service that did not stop cleanly
+                os.remove(self.address)
+            else:
+                raise ValueError("A lookup service is already listening on %s" % self.address)
+
+        self.server = LookupServer(self.address, LookupHandler)
+        self.server.service = self
+        signal.signal(signal.SIGTERM, lambda *args: self.stop())
+        signal.signal(signal.SIGHUP, lambda *args: threading.Thread(target=self.reload).start())
+        if self.interval > 0:
+            threading.Thread(target=self.watch, daemon=True).start()
+        LOG.info("Listening on %s" % self.address)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            # let the requests in flight write their reply before the process exits
+            with self.lock:
+                self.lock.wait_for(lambda: self.active == 0, timeout=30)
+            self.server.server_close()
+            self.db.close()
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        LOG.info("Stopped after %s requests" % self.requests)
+
+        return 0
+
+
+def file_lookup(args):
+
+    '''What a job does without the service: read cox1.taxonomy, then look up'''
+    taxonomy, ids = args
+    table = {}
+    for line in read_tsv(taxonomy, "\t", comment=None, fields=[0, 1, 2, 3]):
+        if "#" in line[0]:
+            continue
+        table[line[0]] = line[1:]
+
+    return sum(1 for i in ids if i in table)
+
+
+def service_lookup(args):
+
+    address, ids = args
+    with LookupClient(address) as client:
+        return sum(1 for i in client.protein(ids) if i is not None)
+
+
+def bench_service(address, queries=10000, jobs=4, seed=0):
+
+    '''Time jobs parallel jobs each looking up queries protein ids, from the file and from the service'''
+    with LookupClient(address) as client:
+        taxonomy = client.info()["files"]["taxonomy"]
+    if not taxonomy:
+        raise ValueError("The service on %s has no cox1 taxonomy table" % address)
+    ids = [i[0] for i in read_tsv(taxonomy, "\t", fields=[0])]
+    rng = random.Random(seed)
+    tasks = [[rng.choice(ids) for _ in range(queries)] for _ in range(jobs)]
+
+    print("#path\tjobs\tqueries\tseconds\tlookups/s")
+    pool = multiprocessing.Pool(jobs)
+    for name, func, source in [("file", file_lookup, taxonomy), ("service", service_lookup, address)]:
+        start = time.perf_counter()
+        found = sum(pool.map(func, [(source, i) for i in tasks]))
+        seconds = time.perf_counter() - start
+        print("%s\t%s\t%s\t%.3f\t%.0f" % (name, jobs, queries * jobs, seconds, queries * jobs / seconds))
+        LOG.info("%s: found %s of %s protein ids" % (name, found, queries * jobs))
+    pool.close()
+    pool.join()
+
+    return 0
+
+
+def add_help_args(parser):
+
+    parser.add_argument("input", nargs="?", metavar="FILE", type=str, default=None,
+        help="Input cox1 taxonomy table(cox1.taxonomy.tsv.gz).")
+    parser.add_argument("-s", "--socket", metavar="FILE", type=str, default="cox1.sock",
+        help="Unix socket of the service, default=cox1.sock.")
+    parser.add_argument("-tax", "--taxonomy", metavar="FILE", type=str, default=None,
+        help="Kraken taxonomy (kraken.taxonomy.gz) for the taxid lookups of desc2tax.py.")
+    parser.add_argument("-c", "--cache", metavar="FILE", type=str, default=None,
+        help="Compiled cache of --taxonomy, (re)built when missing or stale.")
+    parser.add_argument("-pt", "--prot2taxid", metavar="FILE", type=str, default=None,
+        help="prot.accession2taxid.gz for the accession lookups.")
+    parser.add_argument("-i", "--index", metavar="FILE", type=str, default=None,
+        help="Index of --prot2taxid (protid2taxid.py --build-index), (re)built when missing or stale.")
+    parser.add_argument("--interval", metavar="FLOAT", type=float, default=5,
+        help="Seconds between checks for changed database files, 0 to only reload on SIGHUP, default=5.")
+    parser.add_argument("--reload", action="store_true",
+        help="Ask the running service to reload its files.")
+    parser.add_argument("--stop", action="store_true",
+        help="Stop the running service.")
+    parser.add_argument("--bench", action="store_true",
+        help="Compare the lookups of the running service with reading the input file.")
+    parser.add_argument("--queries", metavar="INT", type=int, default=10000,
+        help="Protein ids looked up by each --bench job, default=10000.")
+    parser.add_argument("-j", "--jobs", metavar="INT", type=int, default=4,
+        help="Parallel --bench jobs, default=4.")
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     cox1_server.py: Serve cox1 taxonomy lookups from memory on a Unix socket.
+
+     Loads cox1.taxonomy.tsv.gz (and optionally the kraken taxonomy and the
+     accession2taxid index) once and answers batched lookups by protein id,
+     taxid, accession or lineage prefix. The tables are reloaded when the
+     files change (checked every --interval seconds) or on SIGHUP.
+     cox1_tax2krona.py, otu2krona.py and desc2tax.py use it with --server.
+
+attention:
+     cox1_server.py cox1.taxonomy.tsv.gz -tax kraken.taxonomy.gz -s cox1.sock &
+     desc2tax.py cox1.describe.tsv --server cox1.sock >cox1.taxonomy.tsv
+     cox1_tax2krona.py cox1.taxonomy.tsv.gz --server cox1.sock >cox1.tax2krona.tsv
+     cox1_server.py -s cox1.sock --bench --jobs 8
+     cox1_server.py -s cox1.sock --stop
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    if args.reload or args.stop or args.bench:
+        if args.bench:
+            return bench_service(args.socket, args.queries, args.jobs)
+        with LookupClient(args.socket) as client:
+            r = client.reload() if args.reload else client.shutdown()
+        LOG.info("%s: %s" % ("reload" if args.reload else "stop", r))
+        return 0
+    if not args.input and not args.taxonomy:
+        parser.error("give a cox1 taxonomy table, --taxonomy or both")
+    if args.prot2taxid and not args.index:
+        parser.error("--prot2taxid needs --index")
+
+    service = LookupService(args.socket, args.interval, taxonomy=args.input, kraken=args.taxonomy,
+                            cache=args.cache, prot2taxid=args.prot2taxid, index=args.index)
+    service.serve()
+
+
+if __name__ == "__main__":
+
+    main()
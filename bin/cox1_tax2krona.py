@@ -2,14 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import os
-import re
 import sys
-import gzip
 import logging
 import argparse
 
-import numpy as np
-from collections import OrderedDict
+from cox1db.reader import read_tsv
+from cox1db.lineage import LineageTable
+from cox1db.client import LookupClient
+from cox1db.writer import open_output, add_output_args
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
 
 LOG = logging.getLogger(__name__)
 
@@ -19,84 +21,76 @@ __email__ = "invicoun@foxmail.com"
 __all__ = []
 
 
-def read_tsv(file, sep="\t"):
+def read_cox1_tax(file, table, columns=None, server=None):
 
-    if file.endswith(".gz"):
-        fh = gzip.open(file)
-    else:
-        fh = open(file)
+    '''Count the proteins of each lineage, keyed by its id in table
 
-    for line in fh:
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
-        line = line.strip()
+    With columns the counts come from a bincount over the lineage codes of
+    the memory-mapped column file (converted from file when missing or stale).
+    With server they come from a cox1_server.py that loaded file.
+    '''
+    data = {}
 
-        if not line:
-            continue
+    if server:
+        with LookupClient(server) as client:
+            loaded = client.info()["files"]["taxonomy"]
+            if not loaded or os.path.realpath(loaded) != os.path.realpath(file):
+                raise ValueError("The service on %s serves %s, not %s" % (server, loaded, file))
+            for tax, count in client.counts():
+                data[table.intern(tax)] = count
+        return data
 
-        yield line.split(sep)
+    if columns:
+        from cox1db.columnar import load_cox1_taxonomy
 
-    fh.close()
+        cols = load_cox1_taxonomy(file, columns)
+        counts = cols.lineage_counts().tolist()
+        for tax, count in zip(cols.lineages.tolist(), counts):
+            data[table.intern(tax)] = count
+        return data
 
+    lines = read_tsv(file, sep="\t", comment=None, fields=[0, 1])
 
-def read_cox1_tax(file):
+    return count_lineages((i[1] for i in lines if "#" not in i[0]), table)
 
-    data = {}
 
-    for line in read_tsv(file, sep="\t"):
-        if "#" in line[0]:
-            continue
+def count_lineages(lineages, table):
 
-        if line[1] not in data:
-            data[line[1]] = 0
-        data[line[1]] += 1
+    data = {}
 
-    return data
+    for tax in lineages:
+        lid = table.intern(tax)
+        if lid not in data:
+            data[lid] = 0
+        data[lid] += 1
 
+    return data
 
-def split_tax(tax):
 
-    r = OrderedDict()
+def write_krona(data, table, fo=None):
 
-    for i in tax.split("|"):
-        level, value = i.split("__", 1)
-        if (level == "k") and (level in r):
+    fo = fo or sys.stdout
+    for i in data:
+        abund = int(data[i])
+        if abund <= 0:
             continue
-        if "s" == level:
-            value = value.split(".")[0]
-        r[level] = value
-
-    return r
+        tax = table.read_tax(i)
 
+        fo.write("%s\t%s\n" % (abund, "\t".join(tax)))
 
-def read_tax(tax):
-
-    data = split_tax(tax)
-    index = list(data.keys())
-    r = []
-
-    for i in  ["k", "p", "c", "o", "f", "g", "s"]:
-        if i in data:
-            r.append("%s__%s" % (i, data[i]))
-            if index[-1] == i:
-                break
-        else:
-            r.append("%s__unclassified" % i)
-
-    return r
-
+    return 0
 
-def cox1_tax2krona(file):
 
-    data = read_cox1_tax(file)
+def cox1_tax2krona(file, columns=None, server=None, output="-", compress=None):
 
-    for i in data:
-        abund = int(data[i])
-        if abund <= 0:
-            continue
-        tax = read_tax(i)
+    table = LineageTable()
+    with stats.stage("count", nbytes=os.path.getsize(file)) as st:
+        data = read_cox1_tax(file, table, columns, server)
+        st.records = sum(data.values())
+    stats.size("lineages", data)
 
-        print("%s\t%s" % (abund, "\t".join(tax)))
+    with stats.stage("write", records=len(data)), open_output(output, compress) as fo:
+        write_krona(data, table, fo)
 
     return 0
 
@@ -105,6 +99,13 @@ def add_help_args(parser):
 
     parser.add_argument("input", metavar="FILE", type=str,
         help="Input annotated otu abundance table.")
+    parser.add_argument("-c", "--columns", metavar="FILE", type=str, default=None,
+        help="Columnar form of the input (tax2columns.py), converted when missing or older than the input.")
+    parser.add_argument("--server", metavar="FILE", type=str, default=None,
+        help="Take the counts from a running cox1_server.py (its Unix socket) that loaded the input.")
+
+    add_output_args(parser)
+    add_stats_args(parser)
 
     return parser
 
@@ -125,6 +126,8 @@ name:
 
 attention:
      cox1_tax2krona.py cox1.taxonomy.tsv.gz
+     cox1_tax2krona.py cox1.taxonomy.tsv.gz --columns cox1.taxonomy.tsv.gz.col
+     cox1_tax2krona.py cox1.taxonomy.tsv.gz --server cox1.sock
 
 version: %s
 contact:  %s <%s>\
@@ -132,7 +135,8 @@ contact:  %s <%s>\
 
     args = add_help_args(parser).parse_args()
 
-    cox1_tax2krona(args.input)
+    with instrument(args):
+        cox1_tax2krona(args.input, args.columns, args.server, args.output, args.compress)
 
 
 if __name__ == "__main__":
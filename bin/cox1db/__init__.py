@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+__version__ = "v1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import json
+import socket
+import logging
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["LookupClient"]
+
+
+class LookupClient(object):
+
+    '''Thin client of the cox1_server.py lookup service
+
+    Requests and replies are one json object per line over a Unix socket.
+    Lookups of many keys are sent in batches of batch keys; the values come
+    back in the order of the keys, None for the unknown ones.
+    '''
+
+    def __init__(self, address, batch=10000, timeout=None):
+
+        self.address = address
+        self.batch = batch
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(address)
+        except OSError as e:
+            self.sock.close()
+            raise ValueError("Can not connect to the lookup service %s: %s" % (address, e))
+        self.fh = self.sock.makefile("rb")
+
+    def request(self, op, keys=None):
+
+        r = {"op": op}
+        if keys is not None:
+            r["keys"] = keys
+        self.sock.sendall(json.dumps(r).encode("utf-8") + b"\n")
+        line = self.fh.readline()
+        if not line:
+            raise ValueError("The lookup service %s closed the connection" % self.address)
+        r = json.loads(line.decode("utf-8"))
+        if "error" in r:
+            raise ValueError("%s: %s" % (self.address, r["error"]))
+
+        return r["result"]
+
+    def lookup(self, op, keys):
+
+        keys = list(keys)
+        r = []
+        for i in range(0, len(keys), self.batch):
+            r += self.request(op, keys[i:i+self.batch])
+
+        return r
+
+    def protein(self, protein_ids):
+
+        '''[tax, tax_id, organism] of each protein id of cox1.taxonomy'''
+        return self.lookup("protein", protein_ids)
+
+    def taxid(self, taxids):
+
+        '''Lineage of each taxid, from the kraken taxonomy when the service has one'''
+        return self.lookup("taxid", taxids)
+
+    def accession(self, accessions):
+
+        '''Taxid of each protein accession, from the accession2taxid index'''
+        return self.lookup("accession", accessions)
+
+    def prefix(self, prefixes):
+
+        '''[[lineage, proteins], ...] of the lineages starting with each prefix'''
+        return self.lookup("prefix", prefixes)
+
+    def select(self, taxids):
+
+        '''[[taxid, lineage], ...] of the known taxids in kraken taxonomy file order'''
+        return self.request("select", list(taxids))
+
+    def counts(self):
+
+        '''[[lineage, proteins], ...] of cox1.taxonomy in first row order'''
+        return self.request("counts")
+
+    def info(self):
+
+        return self.request("info")
+
+    def reload(self):
+
+        return self.request("reload")
+
+    def shutdown(self):
+
+        return self.request("shutdown")
+
+    def close(self):
+
+        self.fh.close()
+        self.sock.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+        return False
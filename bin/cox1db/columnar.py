@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import mmap
+import struct
+import logging
+
+import numpy as np
+
+from cox1db.reader import source_stat, read_tsv
+from cox1db.lineage import RANKS, LineageTable
+from cox1db.lca import NONE, encode_lineage
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["write_columns", "ColumnFile", "compile_cox1_taxonomy",
+           "Cox1Taxonomy", "load_cox1_taxonomy"]
+
+COLUMN_MAGIC = b"COX1COLS"
+HEADER = struct.Struct("<Q")
+
+
+
+def encode_strings(values):
+
+    '''Return (uint64 offsets, blob) of a list of bytes strings'''
+    offsets = np.zeros(len(values)+1, dtype=np.uint64)
+    np.cumsum([len(i) for i in values], out=offsets[1:])
+
+    return offsets, b"".join(values)
+
+
+def write_columns(file, columns, header=None):
+
+    '''Write named columns to a memory-mappable file
+
+    columns is a list of (name, value) where value is a numpy array or a list
+    of bytes strings (stored as uint64 offsets and a blob). Every block is
+    8 byte aligned; the json header records name, dtype, shape and offset.
+    '''
+    blocks = []
+    meta = []
+
+    for name, value in columns:
+        if isinstance(value, np.ndarray):
+            meta.append({"name": name, "kind": "array", "dtype": value.dtype.str,
+                         "shape": list(value.shape)})
+            blocks.append([np.ascontiguousarray(value).tobytes()])
+        else:
+            offsets, blob = encode_strings(value)
+            meta.append({"name": name, "kind": "strings", "count": len(value)})
+            blocks.append([offsets.tobytes(), blob])
+
+    header = dict(header or {})
+    header["columns"] = meta
+    # reserve room for the offsets before they are known
+    size = len(json.dumps(header)) + 24 * sum(len(i) for i in blocks) + 64
+    start = len(COLUMN_MAGIC) + HEADER.size + size
+    start += -start % 8
+    offset = start
+    for item, block in zip(meta, blocks):
+        item["offset"] = []
+        for data in block:
+            item["offset"].append(offset)
+            offset += len(data) + (-len(data) % 8)
+    text = json.dumps(header).encode("utf-8").ljust(size)
+
+    temp = file + ".tmp"
+    with open(temp, "wb") as fo:
+        fo.write(COLUMN_MAGIC)
+        fo.write(HEADER.pack(len(text)))
+        fo.write(text)
+        fo.write(b"\0" * (start - fo.tell()))
+        for block in blocks:
+            for data in block:
+                fo.write(data)
+                fo.write(b"\0" * (-len(data) % 8))
+    os.replace(temp, file)
+
+    return file
+
+
+class StringColumn(object):
+
+    def __init__(self, mm, offsets, start, count):
+
+        self.mm = mm
+        self.offsets = np.frombuffer(mm, dtype=np.uint64, count=count+1, offset=offsets)
+        self.start = start
+
+    def __len__(self):
+
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+
+        start = self.start + int(self.offsets[i])
+
+        return self.mm[start:self.start+int(self.offsets[i+1])].decode("utf-8")
+
+    def tolist(self):
+
+        blob = self.mm[self.start:self.start+int(self.offsets[-1])].decode("utf-8")
+        offsets = self.offsets.tolist()
+        if blob.isascii():
+            return [blob[offsets[i]:offsets[i+1]] for i in range(len(self))]
+
+        return [self[i] for i in range(len(self))]
+
+
+class ColumnFile(object):
+
+    def __init__(self, file):
+
+        self.fh = open(file, "rb")
+        if self.fh.read(len(COLUMN_MAGIC)) != COLUMN_MAGIC:
+            raise ValueError("%s is not a column file" % file)
+        size = HEADER.unpack(self.fh.read(HEADER.size))[0]
+        self.header = json.loads(self.fh.read(size).decode("utf-8"))
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.columns = {i["name"]: i for i in self.header["columns"]}
+
+    def __getitem__(self, name):
+
+        item = self.columns[name]
+        if item["kind"] == "strings":
+            return StringColumn(self.mm, item["offset"][0], item["offset"][1], item["count"])
+        dtype = np.dtype(item["dtype"])
+        count = int(np.prod(item["shape"]))
+        r = np.frombuffer(self.mm, dtype=dtype, count=count, offset=item["offset"][0])
+
+        return r.reshape(item["shape"])
+
+    def is_stale(self, file):
+
+        stat = source_stat(file)
+
+        return stat["size"] != self.header.get("size") or stat["mtime"] != self.header.get("mtime")
+
+
+def dictionary(values):
+
+    '''Dictionary encode values: (uint32 codes, distinct values in first-seen order)'''
+    index = {}
+    codes = np.fromiter((index.setdefault(i, len(index)) for i in values),
+                        dtype=np.uint32, count=len(values))
+
+    return codes, list(index)
+
+
+def compile_cox1_taxonomy(taxonomy, file):
+
+    '''Convert cox1.taxonomy.tsv(.gz) to the columnar form
+
+    Columns: protein_id, lineage codes and lineage dictionary, the k..s rank
+    names of each lineage (codes into rank_names, NONE after the last rank),
+    tax_id (int64, -1 when not a number) and dictionary encoded organism.
+    '''
+    protein_ids = []
+    lineages = []
+    taxids = []
+    organisms = []
+
+    for line in read_tsv(taxonomy, sep="\t", comment=None, encoding=None):
+        if b"#" in line[0]:
+            continue
+        protein_ids.append(line[0])
+        lineages.append(line[1])
+        taxids.append(int(line[2]) if len(line) > 2 and line[2].isdigit() else -1)
+        organisms.append(line[3] if len(line) > 3 else b"")
+
+    lineage, lineage_dict = dictionary(lineages)
+    organism, organism_dict = dictionary(organisms)
+
+    table = LineageTable()
+    names = {}
+    ranks = np.full((len(lineage_dict), len(RANKS)), NONE, dtype=np.uint32)
+    for i, tax in enumerate(lineage_dict):
+        ranks[i] = encode_lineage(table, table.intern(tax.decode("utf-8")), names)
+
+    header = source_stat(taxonomy)
+    header.update({"source": os.path.abspath(taxonomy), "rows": len(protein_ids)})
+    write_columns(file, [
+        ("protein_id", protein_ids),
+        ("lineage", lineage),
+        ("lineages", lineage_dict),
+        ("ranks", ranks),
+        ("rank_names", [i.encode("utf-8") for i in names]),
+        ("tax_id", np.array(taxids, dtype=np.int64)),
+        ("organism", organism),
+        ("organisms", organism_dict),
+    ], header)
+    LOG.info("Wrote %s rows (%s lineages) of %s to %s" % (
+        len(protein_ids), len(lineage_dict), taxonomy, file))
+
+    return file
+
+
+class Cox1Taxonomy(ColumnFile):
+
+    '''Memory-mapped columnar cox1.taxonomy table'''
+
+    def __init__(self, file):
+
+        super(Cox1Taxonomy, self).__init__(file)
+        self.protein_id = self["protein_id"]
+        self.lineage = self["lineage"]
+        self.lineages = self["lineages"]
+        self.tax_id = self["tax_id"]
+        self.organism = self["organism"]
+        self.organisms = self["organisms"]
+
+    def __len__(self):
+
+        return len(self.lineage)
+
+    def lineage_counts(self):
+
+        '''Rows per lineage, indexed like lineages (first-seen order)'''
+        return np.bincount(self.lineage, minlength=len(self.lineages))
+
+    def rank(self, rank):
+
+        '''Per row codes of a rank into rank_names (NONE after the last rank)'''
+        return self["ranks"][:, RANKS.index(rank)][self.lineage]
+
+
+def load_cox1_taxonomy(taxonomy, file=None):
+
+    '''Open the columnar form of taxonomy, converting it when missing or stale'''
+    file = file or "%s.col" % taxonomy
+
+    if os.path.exists(file):
+        r = Cox1Taxonomy(file)
+        if not r.is_stale(taxonomy):
+            return r
+        LOG.info("Column file %s is stale, converting %s again" % (file, taxonomy))
+    compile_cox1_taxonomy(taxonomy, file)
+
+    return Cox1Taxonomy(file)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import tempfile
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["write_run", "read_run", "merge_runs"]
+
+
+def write_run(records, tmpdir):
+
+    '''Sort (key, n, value) bytes records and write them to a run file in tmpdir
+
+    n is the input order of the record, it breaks the ties between equal keys.
+    '''
+    records.sort()
+    fh = tempfile.NamedTemporaryFile("wb", dir=tmpdir, suffix=".run", delete=False)
+    for key, n, value in records:
+        fh.write(b"%s\t%d\t%s\n" % (key, n, value))
+    fh.close()
+
+    return fh.name
+
+
+def read_run(file):
+
+    with open(file, "rb") as fh:
+        for line in fh:
+            key, n, value = line.rstrip(b"\n").split(b"\t", 2)
+            yield key, int(n), value
+
+
+def merge_runs(runs, last=False):
+
+    '''Merge sorted runs, keep the first record (in input order) of each key, or the last'''
+    prev = None
+    for record in heapq.merge(*[read_run(i) for i in runs]):
+        if prev is not None and prev[0] == record[0]:
+            if last:
+                prev = record
+            continue
+        if last and prev is not None:
+            yield prev
+        elif not last:
+            yield record
+        prev = record
+    if last and prev is not None:
+        yield prev
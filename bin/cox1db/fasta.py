@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import logging
+import collections
+
+from cox1db.reader import read_chunks, read_lines
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["read_fasta", "read_fastq", "read_reads", "split_attr", "index_fasta", "FastaIndex"]
+
+
+def map_file(file):
+
+    '''Memory-map a plain file, None for gzip or empty files'''
+    if file.endswith(".gz") or os.path.getsize(file) == 0:
+        return None
+    with open(file, "rb") as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_fasta_blocks(file):
+
+    '''Yield the raw text of each record (without the leading >)'''
+    mm = map_file(file)
+
+    if mm is not None:
+        start = mm.find(b">")
+        while start >= 0:
+            end = mm.find(b"\n>", start)
+            if end < 0:
+                yield mm[start+1:]
+                break
+            yield mm[start+1:end+1]
+            start = end + 1
+        mm.close()
+        return
+
+    rest = None
+    for chunk in read_chunks(file):
+        if rest is None:
+            start = chunk.find(b">")
+            if start < 0:
+                continue
+            chunk = chunk[start:]
+            rest = b""
+        blocks = (rest + chunk).split(b"\n>")
+        rest = blocks.pop()
+        for block in blocks:
+            yield block.lstrip(b">")
+    if rest:
+        yield rest.lstrip(b">")
+
+
+def read_fasta(file, encoding="utf-8"):
+
+    '''Read fasta file (plain or gzip), yield [header, sequence]
+
+    The sequence lines of a record are joined once; records without
+    sequence are skipped. Plain files are memory-mapped.
+    '''
+    for block in read_fasta_blocks(file):
+        lines = block.split(b"\n")
+        seq = b"".join([i.strip() for i in lines[1:]])
+        if not seq:
+            continue
+        seqid = lines[0].strip().strip(b">")
+        if encoding:
+            seqid, seq = seqid.decode(encoding), seq.decode(encoding)
+        yield [seqid, seq]
+
+
+def read_fastq(file, encoding="utf-8"):
+
+    '''Read fastq file (plain or gzip), yield [name, sequence] of 4 line records'''
+    lines = read_lines(file, comment=None)
+
+    for head in lines:
+        seq = next(lines, b"")
+        next(lines, None)
+        next(lines, None)
+        seqid = head[1:]
+        if encoding:
+            seqid, seq = seqid.decode(encoding), seq.decode(encoding)
+        yield [seqid, seq]
+
+
+def read_reads(file, encoding="utf-8"):
+
+    '''Read fasta or fastq file, told apart by the first character'''
+    chunks = read_chunks(file)
+    first = next(chunks, b"")
+    chunks.close()
+    if first.lstrip().startswith(b"@"):
+        return read_fastq(file, encoding)
+
+    return read_fasta(file, encoding)
+
+
+def split_attr(attributes):
+
+    '''Parse the [tag=value] attributes of an NCBI fasta header'''
+    r = collections.OrderedDict()
+    contents = attributes.strip("[").strip("]").split("] [")
+
+    for content in contents:
+        content = content
+        if not content:
+            continue
+        if "=" not in content:
+            LOG.warning("%r is not a good formated attribute: no tag!" % content)
+            continue
+        tag, value = content.split("=", 1)
+        r[tag] = value
+
+    return r
+
+
+def index_fasta(file, index=None):
+
+    '''Write a samtools style .fai (name, length, offset, linebases, linewidth)'''
+    if file.endswith(".gz"):
+        raise ValueError("Cannot index the compressed fasta %s" % file)
+    index = index or "%s.fai" % file
+    fo = open(index + ".tmp", "w")
+    record = None
+    offset = 0
+
+    with open(file, "rb") as fh:
+        for line in fh:
+            size = len(line)
+            if line.startswith(b">"):
+                if record:
+                    fo.write("%s\t%s\t%s\t%s\t%s\n" % tuple(record[:5]))
+                name = line[1:].split()[0].decode("utf-8") if line[1:].strip() else ""
+                record = [name, 0, offset+size, 0, 0, False]
+            elif record and line.strip():
+                bases = len(line.rstrip(b"\r\n"))
+                if record[5]:
+                    raise ValueError("Different line length in sequence %r of %s" % (record[0], file))
+                if record[3] == 0:
+                    record[3], record[4] = bases, size
+                elif bases != record[3] or size != record[4]:
+                    # only the last line of a record may be shorter
+                    if bases > record[3]:
+                        raise ValueError("Different line length in sequence %r of %s" % (record[0], file))
+                    record[5] = True
+                record[1] += bases
+            elif record:
+                record[5] = True
+            offset += size
+    if record:
+        fo.write("%s\t%s\t%s\t%s\t%s\n" % tuple(record[:5]))
+    fo.close()
+    os.replace(index + ".tmp", index)
+
+    return index
+
+
+class FastaIndex(object):
+
+    '''Random access to the records of a plain fasta through its .fai'''
+
+    def __init__(self, file, index=None):
+
+        index = index or "%s.fai" % file
+        if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(file):
+            LOG.info("Indexing %s" % file)
+            index_fasta(file, index)
+        self.file = file
+        self.index = index
+        self.names = None
+        self.fh = open(file, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def records(self):
+
+        '''Yield (name, length, offset, linebases, linewidth) in file order'''
+        with open(self.index) as fh:
+            for line in fh:
+                name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")
+                yield name, int(length), int(offset), int(linebases), int(linewidth)
+
+    def header(self, offset):
+
+        start = self.mm.rfind(b"\n", 0, offset-1) + 1
+
+        return self.mm[start:offset].strip().strip(b">")
+
+    def sequence(self, length, offset, linebases, linewidth):
+
+        if length == 0:
+            return b""
+        lines, rest = divmod(length, linebases)
+        end = offset + lines * linewidth + rest
+        seq = self.mm[offset:end]
+        if linewidth != linebases:
+            seq = seq.replace(b"\r", b"").replace(b"\n", b"")
+
+        return seq
+
+    def fetch(self, name):
+
+        '''Sequence of the record name, the .fai is read into a dict on the first call'''
+        if self.names is None:
+            self.names = {}
+            for record in self.records():
+                self.names.setdefault(record[0], record[1:])
+        record = self.names.get(name)
+        if record is None:
+            raise KeyError(name)
+
+        return self.sequence(*record).decode("utf-8")
+
+    def __iter__(self):
+
+        '''Same records as read_fasta, read one at a time'''
+        for name, length, offset, linebases, linewidth in self.records():
+            if length == 0:
+                continue
+            seqid = self.header(offset).decode("utf-8")
+            yield [seqid, self.sequence(length, offset, linebases, linewidth).decode("utf-8")]
+
+    def close(self):
+
+        self.mm.close()
+        self.fh.close()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+
+import numpy as np
+
+from cox1db.reader import source_stat
+from cox1db.fasta import read_fasta
+from cox1db.lineage import RANKS, LineageTable
+from cox1db.lca import NONE, read_lineages, encode_lineage, group_lca
+from cox1db.columnar import write_columns, ColumnFile
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["seq_kmers", "build_kmer_index", "KmerIndex"]
+
+MAX_K = 31
+BASES = np.full(256, 4, dtype=np.uint8)
+for _base, _code in zip(b"ACGTacgt", [0, 1, 2, 3, 0, 1, 2, 3]):
+    BASES[_base] = _code
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def seq_kmers(seq, k=MAX_K, window=0):
+
+    '''Canonical k-mers (2 bits a base, uint64) of a bytes sequence
+
+    k-mers over a non ACGT base are dropped. With window > 1 only the
+    minimizers are kept: the k-mer of smallest hash of each window
+    consecutive k-mers, each position once.
+    '''
+    codes = BASES[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    bad = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.cumsum(codes > 3, out=bad[1:])
+    good = bad[k:] - bad[:-k] == 0
+    codes = np.where(codes > 3, 0, codes).astype(np.uint64)
+    comp = np.uint64(3) - codes
+    fwd = np.zeros(n, dtype=np.uint64)
+    rev = np.zeros(n, dtype=np.uint64)
+    four = np.uint64(4)
+    for j in range(k):
+        fwd = fwd * four + codes[j:j+n]
+        rev = rev * four + comp[k-1-j:k-1-j+n]
+    kmers = np.minimum(fwd, rev)[good]
+
+    if window > 1 and len(kmers) > 1:
+        hashes = kmers * MIX
+        hashes ^= hashes >> np.uint64(29)
+        if len(kmers) <= window:
+            return kmers[[np.argmin(hashes)]]
+        view = np.lib.stride_tricks.sliding_window_view(hashes, window)
+        pos = np.unique(np.arange(len(view)) + view.argmin(axis=1))
+        kmers = kmers[pos]
+
+    return kmers
+
+
+class NodeTable(object):
+
+    '''Intern rank code rows (lineages and their ancestors) into node ids'''
+
+    def __init__(self):
+
+        self.index = {}
+        self.rows = []
+
+    def add(self, row):
+
+        row = tuple(row)
+        node = self.index.get(row)
+        if node is None:
+            node = self.index[row] = len(self.rows)
+            self.rows.append(row)
+
+        return node
+
+    def array(self):
+
+        return np.array(self.rows, dtype=np.uint32).reshape(-1, len(RANKS))
+
+
+def reduce_kmers(kmers, nodes, table, unclassified):
+
+    '''Sort and merge (k-mer, node) pairs, a k-mer of several nodes gets their LCA'''
+    order = np.argsort(kmers, kind="stable")
+    kmers = kmers[order]
+    nodes = nodes[order]
+    if not len(kmers):
+        return kmers, nodes
+    starts = np.flatnonzero(np.concatenate([[True], kmers[1:] != kmers[:-1]]))
+    counts = np.diff(np.append(starts, len(kmers)))
+
+    first = nodes[starts]
+    same = np.logical_and.reduceat(nodes == np.repeat(first, counts), starts)
+    mixed = ~same
+    if mixed.any():
+        member = np.repeat(mixed, counts)
+        lca = group_lca(table.array()[nodes[member]], counts[mixed], unclassified)
+        first[mixed] = [table.add(i) for i in lca.tolist()]
+
+    return kmers[starts], first
+
+
+def build_kmer_index(fasta, taxonomy, index, k=MAX_K, window=0, batch=2000):
+
+    '''Index the canonical k-mers (or minimizers) of the cox1 nucleotide sequences
+
+    Each k-mer maps to the LCA node of the lineages of the sequences holding
+    it. The sequences are reduced batch by batch to keep the memory low.
+    '''
+    if not 0 < k <= MAX_K:
+        raise ValueError("k must be between 1 and %s" % MAX_K)
+    lineages = read_lineages(taxonomy)
+    table = LineageTable()
+    names = {"unclassified": 0}
+    nodes = NodeTable()
+    parts = []
+    kmers = []
+    lids = []
+    n = skipped = 0
+
+    for header, seq in read_fasta(fasta, encoding=None):
+        protid = header.split()[0].split(b"|")[0].decode("utf-8")
+        tax = lineages.get(protid)
+        if tax is None:
+            skipped += 1
+            continue
+        lid = table.intern(tax)
+        node = nodes.add(encode_lineage(table, lid, names))
+        km = np.unique(seq_kmers(seq, k, window))
+        kmers.append(km)
+        lids.append(np.full(len(km), node, dtype=np.uint32))
+        n += 1
+        if len(kmers) >= batch:
+            parts.append(reduce_kmers(np.concatenate(kmers), np.concatenate(lids), nodes, 0))
+            kmers = []
+            lids = []
+    if kmers:
+        parts.append(reduce_kmers(np.concatenate(kmers), np.concatenate(lids), nodes, 0))
+    if not parts:
+        raise ValueError("No sequence of %s has a lineage in %s" % (fasta, taxonomy))
+    kmers, lids = reduce_kmers(np.concatenate([i[0] for i in parts]),
+                               np.concatenate([i[1] for i in parts]), nodes, 0)
+
+    header = {"k": k, "window": window, "sequences": n, "fasta": os.path.abspath(fasta),
+              "taxonomy": os.path.abspath(taxonomy), "size": source_stat(fasta)["size"],
+              "mtime": source_stat(fasta)["mtime"]}
+    write_columns(index, [
+        ("kmers", kmers),
+        ("nodes", lids.astype(np.uint32)),
+        ("node_ranks", nodes.array()),
+        ("rank_names", [i.encode("utf-8") for i in names]),
+    ], header)
+    LOG.info("Indexed %s k-mers (k=%s, window=%s) of %s sequences into %s nodes, "
+             "%s sequences without a lineage" % (len(kmers), k, window, n, len(nodes.rows), skipped))
+
+    return index
+
+
+class KmerIndex(ColumnFile):
+
+    '''Memory-mapped k-mer index: sorted k-mers, their node and the node ranks'''
+
+    def __init__(self, file):
+
+        super(KmerIndex, self).__init__(file)
+        self.k = self.header["k"]
+        self.window = self.header["window"]
+        self.kmers = self["kmers"]
+        self.nodes = self["nodes"]
+        self.node_ranks = self["node_ranks"]
+        self.names = self["rank_names"].tolist()
+
+    def __len__(self):
+
+        return len(self.kmers)
+
+    def lookup(self, kmers):
+
+        '''Node of each k-mer, NONE when it is not in the index'''
+        pos = np.searchsorted(self.kmers, kmers)
+        pos[pos >= len(self.kmers)] = 0
+        found = self.kmers[pos] == kmers
+        r = np.full(len(kmers), NONE, dtype=np.uint32)
+        r[found] = self.nodes[pos[found]]
+
+        return r
+
+    def lineage(self, row):
+
+        '''k__...|s__... string of a rank code row, "" for the root'''
+        return "|".join("%s__%s" % (rank, self.names[i]) for rank, i in zip(RANKS, row) if i != NONE)
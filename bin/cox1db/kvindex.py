@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import mmap
+import shutil
+import struct
+import logging
+import tempfile
+
+from cox1db.reader import source_stat
+from cox1db.extsort import write_run, merge_runs
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["build_kv", "KVIndex"]
+
+KV_MAGIC = b"KVINDEX1"
+HEADER = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+
+
+
+def build_kv(pairs, index, header=None, buffer_size=10000000):
+
+    '''Build a sorted on-disk key -> value index from (key, value) bytes pairs
+
+    Keys and values must not hold tab or newline; of duplicated keys the last
+    pair wins. Layout after the magic and a json header: fixed width keys
+    padded with NUL, uint64 value offsets (count + 1) and the value blob.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix="kv.", dir=os.path.dirname(os.path.abspath(index)))
+    runs = []
+    buffer = []
+    width = 0
+    n = 0
+
+    for key, value in pairs:
+        n += 1
+        buffer.append((key, n, value))
+        width = max(width, len(key))
+        if len(buffer) >= buffer_size:
+            runs.append(write_run(buffer, tmpdir))
+            buffer = []
+    if buffer:
+        runs.append(write_run(buffer, tmpdir))
+        buffer = []
+
+    keys = os.path.join(tmpdir, "keys")
+    offsets = os.path.join(tmpdir, "offsets")
+    blob = os.path.join(tmpdir, "values")
+    count = offset = 0
+    with open(keys, "wb") as fk, open(offsets, "wb") as fs, open(blob, "wb") as fv:
+        fs.write(OFFSET.pack(0))
+        for key, _, value in merge_runs(runs, last=True):
+            fk.write(key.ljust(width, b"\0"))
+            fv.write(value)
+            offset += len(value)
+            fs.write(OFFSET.pack(offset))
+            count += 1
+
+    header = dict(header or {})
+    header.update({"count": count, "width": width})
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-(len(KV_MAGIC) + HEADER.size + len(header)) % 8)
+    pad = -count * width % 8
+
+    with open(index + ".tmp", "wb") as fo:
+        fo.write(KV_MAGIC)
+        fo.write(HEADER.pack(len(header)))
+        fo.write(header)
+        with open(keys, "rb") as fh:
+            shutil.copyfileobj(fh, fo, 1 << 24)
+        fo.write(b"\0" * pad)
+        for i in [offsets, blob]:
+            with open(i, "rb") as fh:
+                shutil.copyfileobj(fh, fo, 1 << 24)
+    os.replace(index + ".tmp", index)
+    shutil.rmtree(tmpdir)
+    LOG.info("Indexed %s keys of %s pairs into %s" % (count, n, index))
+
+    return index
+
+
+class KVIndex(object):
+
+    '''Sorted key -> value lookups by bisection over the memory-mapped index'''
+
+    def __init__(self, index, encoding=None):
+
+        self.encoding = encoding
+        self.fh = open(index, "rb")
+        if self.fh.read(len(KV_MAGIC)) != KV_MAGIC:
+            raise ValueError("%s is not a key-value index" % index)
+        size = HEADER.unpack(self.fh.read(HEADER.size))[0]
+        self.header = json.loads(self.fh.read(size).decode("utf-8"))
+        self.count = self.header["count"]
+        self.width = self.header["width"]
+
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = len(KV_MAGIC) + HEADER.size + size
+        start = self.start + self.count * self.width
+        start += -start % 8
+        self.offsets = memoryview(self.mm)[start:start+8*(self.count+1)].cast("Q")
+        self.blob = start + 8 * (self.count + 1)
+
+    def is_stale(self, file):
+
+        stat = source_stat(file)
+
+        return stat["size"] != self.header.get("size") or stat["mtime"] != self.header.get("mtime")
+
+    def find(self, key):
+
+        if self.encoding:
+            key = key.encode(self.encoding)
+        if len(key) > self.width:
+            return -1
+        key = key.ljust(self.width, b"\0")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.start + mid * self.width
+            if self.mm[pos:pos+self.width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos = self.start + lo * self.width
+        if lo < self.count and self.mm[pos:pos+self.width] == key:
+            return lo
+
+        return -1
+
+    def get(self, key, default=None):
+
+        i = self.find(key)
+        if i < 0:
+            return default
+
+        value = self.mm[self.blob+self.offsets[i]:self.blob+self.offsets[i+1]]
+        if self.encoding:
+            value = value.decode(self.encoding)
+
+        return value
+
+    def __contains__(self, key):
+
+        return self.find(key) >= 0
+
+    def close(self):
+
+        self.offsets.release()
+        self.mm.close()
+        self.fh.close()
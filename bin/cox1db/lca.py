@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+
+from cox1db.reader import read_tsv
+from cox1db.lineage import RANKS, LineageTable
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["NONE", "read_lineages", "encode_lineage", "encode_lineages", "decode_lineages",
+           "group_lca", "lca"]
+
+NONE = np.iinfo(np.uint32).max
+
+
+def read_lineages(taxonomy):
+
+    '''protein_id -> lineage of cox1.taxonomy.tsv'''
+    r = {}
+    for line in read_tsv(taxonomy, "\t", comment=None, fields=[0, 1]):
+        if "#" in line[0]:
+            continue
+        r[line[0]] = line[1]
+
+    return r
+
+
+def encode_lineage(table, lid, names):
+
+    '''k..s rank codes of an interned lineage, new names get the next code in names'''
+    return [names.setdefault(i, len(names)) if i is not None else NONE for i in table.ranks[lid]]
+
+
+def encode_lineages(lineages, names=None):
+
+    '''Encode lineage strings as a (n, 7) uint32 array of rank codes
+
+    Ranks missing inside a lineage get the code of "unclassified", the
+    ranks after its last one NONE. Returns the array and names, the dict of
+    rank name -> code (first-seen order unless names is given).
+    '''
+    table = LineageTable()
+    names = {} if names is None else names
+    rows = np.full((len(lineages), len(RANKS)), NONE, dtype=np.uint32)
+
+    for i, tax in enumerate(lineages):
+        rows[i] = encode_lineage(table, table.intern(tax), names)
+
+    return rows, names
+
+
+def decode_lineages(rows, names):
+
+    '''k__...|s__... string of each row of rank codes, "" for the root'''
+    names = list(names)
+    cache = {}
+    r = []
+
+    for row in map(tuple, rows.tolist()):
+        tax = cache.get(row)
+        if tax is None:
+            tax = cache[row] = "|".join("%s__%s" % (rank, names[i])
+                                        for rank, i in zip(RANKS, row) if i != NONE)
+        r.append(tax)
+
+    return r
+
+
+def group_starts(counts):
+
+    starts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+
+    return starts
+
+
+def strict_depth(rows, counts, starts):
+
+    '''Number of leading ranks every row of a group shares with its first row'''
+    first = np.repeat(rows[starts], counts, axis=0)
+    same = np.cumprod(rows == first, axis=1).sum(axis=1)
+
+    return np.minimum.reduceat(same, starts), starts
+
+
+def consensus_depth(rows, counts, starts, consensus):
+
+    '''Deepest rank whose most common prefix holds at least consensus of the group
+
+    Returns the depth and, per group, a row holding that prefix. Prefixes are
+    numbered rank by rank: the id at rank j encodes the id at rank j-1 and
+    the code at j, so equal ids mean equal lineages down to j.
+    '''
+    groups = np.repeat(np.arange(len(counts)), counts)
+    need = np.ceil(counts * consensus - 1e-9).astype(np.int64)
+    depth = np.zeros(len(counts), dtype=np.int64)
+    best = starts.copy()
+    alive = np.ones(len(counts), dtype=bool)
+    prefix = np.zeros(len(rows), dtype=np.int64)
+
+    for j in range(rows.shape[1]):
+        codes = rows[:, j].astype(np.int64)
+        _, prefix = np.unique(prefix * (int(codes.max()) + 1) + codes, return_inverse=True)
+        _, index, size = np.unique(groups * (int(prefix.max()) + 1) + prefix,
+                                       return_index=True, return_counts=True)
+        owner = groups[index]
+        order = np.lexsort((-size, owner))
+        top = order[np.flatnonzero(np.concatenate([[True], owner[order][1:] != owner[order][:-1]]))]
+        ok = alive & (size[top] >= need)
+        depth[ok] = j + 1
+        best[ok] = index[top][ok]
+        alive = ok
+
+    return depth, best
+
+
+def group_lca(rows, counts, unclassified=None, consensus=1.0):
+
+    '''Lowest common ancestor of consecutive groups of rank code rows
+
+    rows is a (n, 7) array of k..s codes (NONE after the last rank), counts
+    the size of each group. Returns one row per group: the ranks shared by
+    every row of the group, or with consensus < 1 by at least that fraction
+    of them (more than half), trailing unclassified codes removed.
+    '''
+    counts = np.asarray(counts, dtype=np.int64)
+    if not len(counts):
+        return np.zeros((0, rows.shape[1]), dtype=np.uint32)
+    starts = group_starts(counts)
+    if consensus >= 1:
+        depth, best = strict_depth(rows, counts, starts)
+    elif consensus > 0.5:
+        depth, best = consensus_depth(rows, counts, starts, consensus)
+    else:
+        raise ValueError("consensus must be more than 0.5 and at most 1, not %s" % consensus)
+
+    r = rows[best].copy()
+    r[np.arange(rows.shape[1]) >= depth[:, None]] = NONE
+    if unclassified is not None:
+        for j in range(rows.shape[1] - 1, -1, -1):
+            tail = r[:, j] == unclassified
+            if j + 1 < rows.shape[1]:
+                tail &= r[:, j+1] == NONE
+            r[tail, j] = NONE
+
+    return r
+
+
+def lca(groups, consensus=1.0):
+
+    '''Lineage string of the LCA of each group (a list of lineage strings)'''
+    index = {}
+    members = []
+    counts = []
+
+    for group in groups:
+        counts.append(len(group))
+        for tax in group:
+            members.append(index.setdefault(tax, len(index)))
+    if not members:
+        return [""] * len(counts)
+    rows, names = encode_lineages(list(index))
+    counts = np.array(counts, dtype=np.int64)
+    keep = counts > 0
+    r = np.full((len(counts), len(RANKS)), NONE, dtype=np.uint32)
+    r[keep] = group_lca(rows[members], counts[keep], names.get("unclassified"), consensus)
+
+    return decode_lineages(r, names)
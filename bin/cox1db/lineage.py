@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+
+from collections import OrderedDict
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["RANKS", "split_tax", "read_tax", "LineageTable", "common_lineage"]
+
+RANKS = ("k", "p", "c", "o", "f", "g", "s")
+
+
+def split_tax(tax):
+
+    r = OrderedDict()
+
+    for i in tax.split("|"):
+        if "__" not in i:
+            continue
+        level, value = i.split("__", 1)
+        if (level == "k") and (level in r):
+            continue
+        if "s" == level:
+            value = value.split(".")[0]
+        r[level] = value
+
+    return r
+
+
+def read_tax(tax):
+
+    data = split_tax(tax)
+    index = list(data.keys())
+    r = []
+
+    for i in  RANKS:
+        if i in data:
+            r.append("%s__%s" % (i, data[i]))
+            if index[-1] == i:
+                break
+        else:
+            r.append("%s__unclassified" % i)
+
+    return r
+
+
+class LineageTable(object):
+
+    '''Intern k__...|s__... lineage strings into integer ids
+
+    Each distinct lineage is parsed once. ranks[lid] is a 7-tuple of the
+    interned k..s names ("unclassified" for missing ranks, None after the
+    last rank of the lineage), krona[lid] the read_tax list as a tuple.
+    '''
+
+    def __init__(self):
+
+        self.index = {}
+        self.lineages = []
+        self.ranks = []
+        self.krona = []
+
+    def intern(self, tax):
+
+        lid = self.index.get(tax)
+        if lid is not None:
+            return lid
+
+        lid = len(self.lineages)
+        self.index[tax] = lid
+        self.lineages.append(tax)
+        krona = tuple(sys.intern(i) for i in read_tax(tax))
+        self.krona.append(krona)
+        ranks = [sys.intern(i.split("__", 1)[1]) for i in krona]
+        self.ranks.append(tuple(ranks + [None] * (len(RANKS) - len(ranks))))
+
+        return lid
+
+    def read_tax(self, lid):
+
+        return self.krona[lid]
+
+    def rank(self, lid, rank):
+
+        return self.ranks[lid][RANKS.index(rank)]
+
+    def __len__(self):
+
+        return len(self.lineages)
+
+    def __getitem__(self, lid):
+
+        return self.lineages[lid]
+
+
+def common_lineage(table, lids):
+
+    '''Lowest common lineage of interned lineages, the krona ranks they all share'''
+    krona = table.krona[lids[0]]
+    depth = len(krona)
+
+    for lid in lids[1:]:
+        other = table.krona[lid]
+        n = 0
+        while n < min(depth, len(other)) and other[n] == krona[n]:
+            n += 1
+        depth = n
+    while depth and krona[depth-1].endswith("__unclassified"):
+        depth -= 1
+
+    return "|".join(krona[:depth])
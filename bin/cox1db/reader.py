@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import queue
+import shutil
+import logging
+import threading
+import subprocess
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["source_stat", "open_file", "read_chunks", "read_lines", "read_tsv"]
+
+CHUNK_SIZE = 1 << 22
+GZIP_TOOLS = [("pigz", ["-dc", "-p"]), ("igzip", ["-dc", "-T"])]
+
+
+class ProcessReader(object):
+
+    '''Read the stdout of an external decompressor (pigz/igzip)'''
+
+    def __init__(self, file, exe, args, threads):
+
+        self.proc = subprocess.Popen([exe] + args + [str(threads), file],
+            stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
+        self.name = file
+        self.killed = False
+
+    def read(self, size=-1):
+
+        return self.proc.stdout.read(size)
+
+    def close(self):
+
+        if self.proc.poll() is None:
+            self.killed = True
+            self.proc.terminate()
+        self.proc.stdout.close()
+        code = self.proc.wait()
+        if code != 0 and not self.killed:
+            raise IOError("Failed to decompress %s (exit %s)" % (self.name, code))
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+class ThreadedReader(object):
+
+    '''Decompress in a background thread, zlib releases the GIL while it runs'''
+
+    def __init__(self, fh, size=CHUNK_SIZE, depth=4):
+
+        self.fh = fh
+        self.queue = queue.Queue(depth)
+        self.stop = threading.Event()
+        self.buffer = b""
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(size,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, size):
+
+        try:
+            while not self.stop.is_set():
+                chunk = self.fh.read(size)
+                self.queue.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self.error = e
+            self.queue.put(b"")
+
+    def read(self, size=-1):
+
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.queue.get()
+            if not chunk:
+                self.queue.put(b"")
+                break
+            self.buffer += chunk
+        if self.error:
+            raise self.error
+        if size < 0:
+            size = len(self.buffer)
+        r, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return r
+
+    def close(self):
+
+        self.stop.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.fh.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+def source_stat(file):
+
+    '''Size and mtime of file, recorded by the indexes to tell when they are stale'''
+    st = os.stat(file)
+
+    return {"size": st.st_size, "mtime": int(st.st_mtime)}
+
+
+def gzip_tool():
+
+    if os.environ.get("COX1DB_GZIP") == "python":
+        return None, None
+    for exe, args in GZIP_TOOLS:
+        path = shutil.which(exe)
+        if path:
+            return path, args
+
+    return None, None
+
+
+def open_file(file, threads=None):
+
+    '''Open a plain or gzip file for binary reading
+
+    Gzip input is decompressed by pigz/igzip when one is on the PATH (set
+    COX1DB_GZIP=python to disable), otherwise by zlib in a background thread.
+    '''
+    if not file.endswith(".gz"):
+        return open(file, "rb")
+
+    exe, args = gzip_tool()
+    if exe:
+        return ProcessReader(file, exe, args, threads or os.cpu_count() or 1)
+
+    return ThreadedReader(gzip.open(file, "rb"))
+
+
+def read_chunks(file, size=CHUNK_SIZE, threads=None):
+
+    '''Yield blocks of complete lines (bytes) from a plain or gzip file'''
+    fh = open_file(file, threads)
+    rest = b""
+
+    try:
+        while True:
+            chunk = fh.read(size)
+            if not chunk:
+                break
+            end = chunk.rfind(b"\n")
+            if end < 0:
+                rest += chunk
+                continue
+            yield rest + chunk[:end+1]
+            rest = chunk[end+1:]
+        if rest:
+            yield rest
+    finally:
+        fh.close()
+
+
+def read_lines(file, comment="#", threads=None):
+
+    '''Yield stripped, non-empty lines as bytes'''
+    comment = comment.encode("utf-8") if comment else None
+
+    for chunk in read_chunks(file, threads=threads):
+        for line in chunk.split(b"\n"):
+            line = line.strip()
+            if not line:
+                continue
+            if comment and line.startswith(comment):
+                continue
+            yield line
+
+
+def read_tsv(file, sep="\t", comment="#", fields=None, encoding="utf-8", threads=None):
+
+    '''Read a tsv file (plain or gzip) by large binary chunks
+
+    Lines are stripped and blank lines (and lines starting with comment) are
+    skipped. When fields is given only those columns are returned, and only
+    they are decoded; encoding=None returns the raw bytes.
+    '''
+    if sep is not None:
+        sep = sep.encode("utf-8")
+    comment = comment.encode("utf-8") if comment else None
+    maxsplit = -1
+    head = None
+    if fields is not None:
+        maxsplit = max(fields) + 1
+        if list(fields) == list(range(len(fields))):
+            head = len(fields)
+
+    for chunk in read_chunks(file, threads=threads):
+        for line in chunk.split(b"\n"):
+            line = line.strip()
+            if not line or (comment and line.startswith(comment)):
+                continue
+            line = line.split(sep, maxsplit)
+            if head is not None:
+                line = line[:head]
+            elif fields is not None:
+                line = [line[i] for i in fields]
+            if encoding:
+                line = [i.decode(encoding) for i in line]
+            yield line
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import mmap
+import array
+import struct
+import hashlib
+import logging
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["seq_digest", "build_seqhash", "SeqHash"]
+
+SEQHASH_MAGIC = b"SEQHASH1"
+HEADER = struct.Struct("<I")
+DIGEST = struct.Struct("<QQ")
+
+
+def seq_digest(seq):
+
+    '''128 bit blake2b digest of an upper case sequence (str or bytes)'''
+    if isinstance(seq, str):
+        seq = seq.encode("ascii")
+
+    return hashlib.blake2b(seq.upper(), digest_size=16).digest()
+
+
+def build_seqhash(items, index, header=None):
+
+    '''Build an open addressing digest -> value table from (digest, value) pairs
+
+    Layout after the magic and a json header: a power of two number of slots
+    (at least twice the pairs) of two uint64 digest words, the uint64 value
+    number + 1 of each slot (0 is empty), uint64 value offsets and the value
+    blob. A lookup reads one or a few neighbour slots. Of duplicated digests
+    the first pair wins.
+    '''
+    items = list(items)
+    size = 1
+    while size < 2 * len(items):
+        size *= 2
+    mask = size - 1
+
+    keys = array.array("Q", bytes(16 * size))
+    slots = array.array("Q", bytes(8 * size))
+    offsets = array.array("Q", [0])
+    values = []
+
+    for digest, value in items:
+        hi, lo = DIGEST.unpack(digest)
+        i = lo & mask
+        while slots[i] and (keys[2*i], keys[2*i+1]) != (hi, lo):
+            i = (i + 1) & mask
+        if slots[i]:
+            continue
+        keys[2*i], keys[2*i+1] = hi, lo
+        values.append(value)
+        offsets.append(offsets[-1] + len(value))
+        slots[i] = len(values)
+
+    header = dict(header or {})
+    header.update({"slots": size, "count": len(values)})
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-(len(SEQHASH_MAGIC) + HEADER.size + len(header)) % 8)
+
+    with open(index + ".tmp", "wb") as fo:
+        fo.write(SEQHASH_MAGIC)
+        fo.write(HEADER.pack(len(header)))
+        fo.write(header)
+        keys.tofile(fo)
+        slots.tofile(fo)
+        offsets.tofile(fo)
+        for value in values:
+            fo.write(value)
+    os.replace(index + ".tmp", index)
+    LOG.info("Hashed %s sequences into %s slots of %s" % (len(values), size, index))
+
+    return index
+
+
+class SeqHash(object):
+
+    '''Exact sequence lookups in a build_seqhash table'''
+
+    def __init__(self, index, encoding="utf-8"):
+
+        self.encoding = encoding
+        self.fh = open(index, "rb")
+        if self.fh.read(len(SEQHASH_MAGIC)) != SEQHASH_MAGIC:
+            raise ValueError("%s is not a sequence hash index" % index)
+        size = HEADER.unpack(self.fh.read(HEADER.size))[0]
+        self.header = json.loads(self.fh.read(size).decode("utf-8"))
+        self.size = self.header["slots"]
+        self.count = self.header["count"]
+        self.mask = self.size - 1
+
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+        start = len(SEQHASH_MAGIC) + HEADER.size + size
+        self.keys = view[start:start+16*self.size].cast("Q")
+        start += 16 * self.size
+        self.slots = view[start:start+8*self.size].cast("Q")
+        start += 8 * self.size
+        self.offsets = view[start:start+8*(self.count+1)].cast("Q")
+        self.blob = start + 8 * (self.count + 1)
+
+    def find(self, digest):
+
+        '''Value number of digest, -1 when missing'''
+        hi, lo = DIGEST.unpack(digest)
+        i = lo & self.mask
+        while self.slots[i]:
+            if self.keys[2*i+1] == lo and self.keys[2*i] == hi:
+                return self.slots[i] - 1
+            i = (i + 1) & self.mask
+
+        return -1
+
+    def value(self, n):
+
+        value = self.mm[self.blob+self.offsets[n]:self.blob+self.offsets[n+1]]
+        if self.encoding:
+            value = value.decode(self.encoding)
+
+        return value
+
+    def get(self, seq, default=None):
+
+        n = self.find(seq_digest(seq))
+        if n < 0:
+            return default
+
+        return self.value(n)
+
+    def __contains__(self, seq):
+
+        return self.find(seq_digest(seq)) >= 0
+
+    def close(self):
+
+        self.keys.release()
+        self.slots.release()
+        self.offsets.release()
+        self.mm.close()
+        self.fh.close()
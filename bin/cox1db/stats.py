@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import signal
+import logging
+import resource
+import contextlib
+import collections
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["stage", "add", "size", "report", "Sampler", "instrument", "add_stats_args"]
+
+ENABLED = False
+STAGES = collections.OrderedDict()
+SIZES = collections.OrderedDict()
+START = [0.0, 0.0]
+
+
+class Stage(object):
+
+    '''Times a block; set records and nbytes to what it processed'''
+
+    def __init__(self, name, records=0, nbytes=0):
+
+        self.name = name
+        self.records = records
+        self.nbytes = nbytes
+
+    def __enter__(self):
+
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        add(self.name, self.records, self.nbytes)
+        r = STAGES[self.name]
+        r["calls"] += 1
+        r["wall"] += time.perf_counter() - self.wall
+        r["cpu"] += time.process_time() - self.cpu
+
+        return False
+
+
+class NullStage(object):
+
+    '''Shared stand-in for Stage when the stats are off'''
+
+    records = 0
+    nbytes = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name, records=0, nbytes=0):
+
+    '''Context manager timing a stage, a shared no-op unless --stats or --profile'''
+    if not ENABLED:
+        return NULL_STAGE
+
+    return Stage(name, records, nbytes)
+
+
+def add(name, records=0, nbytes=0):
+
+    '''Add records and bytes to a stage without timing it'''
+    if not ENABLED:
+        return
+    r = STAGES.get(name)
+    if r is None:
+        r = STAGES[name] = {"calls": 0, "wall": 0.0, "cpu": 0.0, "records": 0, "bytes": 0}
+    r["records"] += records
+    r["bytes"] += nbytes
+
+
+def size(name, value):
+
+    '''Record the size of a lookup table (len of value, or value)'''
+    if ENABLED:
+        SIZES[name] = len(value) if hasattr(value, "__len__") else value
+
+
+def peak_rss():
+
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return r
+
+    return r * 1024
+
+
+def summary():
+
+    r = {"wall": time.perf_counter() - START[0], "cpu": time.process_time() - START[1],
+         "peak_rss": peak_rss(), "stages": [], "sizes": dict(SIZES)}
+    for name, i in STAGES.items():
+        i = dict(i, name=name)
+        i["records_per_second"] = i["records"] / i["wall"] if i["wall"] else 0
+        r["stages"].append(i)
+
+    return r
+
+
+def report(file=None):
+
+    '''Write the stats to stderr, or as json to file'''
+    r = summary()
+    if file and file != "-":
+        with open(file, "w") as fo:
+            json.dump(r, fo, indent=2)
+        return r
+
+    fo = sys.stderr
+    fo.write("#stage\tcalls\twall_s\tcpu_s\trecords\tbytes\trecords/s\tMB/s\n")
+    for i in r["stages"]:
+        fo.write("%s\t%s\t%.3f\t%.3f\t%s\t%s\t%.0f\t%.2f\n" % (i["name"], i["calls"], i["wall"],
+                 i["cpu"], i["records"], i["bytes"], i["records_per_second"],
+                 i["bytes"] / i["wall"] / 1e6 if i["wall"] else 0))
+    for name, value in r["sizes"].items():
+        fo.write("#size\t%s\t%s\n" % (name, value))
+    fo.write("#total\twall %.3fs\tcpu %.3fs\tpeak_rss %.1fMB\n" % (r["wall"], r["cpu"], r["peak_rss"] / 1e6))
+
+    return r
+
+
+class Sampler(object):
+
+    '''Statistical profiler: sample the Python stack on a CPU time timer
+
+    Counts, per function, the samples where it is running (self) and where
+    it is on the stack (cumulative). Only the main thread of this process is
+    sampled, worker processes are not.
+    '''
+
+    def __init__(self, interval=0.005):
+
+        self.interval = interval
+        self.samples = 0
+        self.own = collections.Counter()
+        self.total = collections.Counter()
+
+    def sample(self, signum, frame):
+
+        self.samples += 1
+        seen = set()
+        top = True
+        while frame is not None:
+            code = frame.f_code
+            key = "%s:%s(%s)" % (code.co_filename, code.co_firstlineno, code.co_name)
+            if top:
+                self.own[key] += 1
+                top = False
+            if key not in seen:
+                seen.add(key)
+                self.total[key] += 1
+            frame = frame.f_back
+
+    def start(self):
+
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, file, top=50):
+
+        with open(file, "w") as fo:
+            fo.write("#%s samples every %sms\n" % (self.samples, self.interval * 1000))
+            fo.write("#self\tself%\tcumulative\tcumulative%\tfunction\n")
+            n = max(self.samples, 1)
+            for key, total in self.total.most_common(top):
+                fo.write("%s\t%.1f\t%s\t%.1f\t%s\n" % (self.own[key], 100.0 * self.own[key] / n,
+                         total, 100.0 * total / n, key))
+
+        return file
+
+
+@contextlib.contextmanager
+def instrument(args):
+
+    '''Turn on the stage stats and the sampler of the add_stats_args options around a block'''
+    global ENABLED
+
+    stats = args.stats_json or ("-" if args.stats else None)
+    if not stats and not args.profile:
+        yield
+        return
+
+    ENABLED = True
+    START[:] = [time.perf_counter(), time.process_time()]
+    sampler = None
+    if args.profile:
+        sampler = Sampler()
+        sampler.start()
+    try:
+        yield
+    finally:
+        if sampler:
+            sampler.stop()
+            sampler.write(args.profile)
+            LOG.info("Wrote %s profile samples to %s" % (sampler.samples, args.profile))
+        if stats:
+            report(stats)
+        ENABLED = False
+
+
+def add_stats_args(parser):
+
+    parser.add_argument("--stats", action="store_true",
+        help="Report the wall and CPU time, records and bytes of each stage, table sizes and peak RSS to stderr.")
+    parser.add_argument("--stats-json", metavar="FILE", type=str, default=None,
+        help="Write the --stats report as json to FILE.")
+    parser.add_argument("--profile", metavar="FILE", type=str, default=None,
+        help="Sample the call stack every 5ms and write the hottest functions to FILE.")
+
+    return parser
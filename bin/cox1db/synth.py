@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import random
+import logging
+
+from cox1db.lineage import RANKS
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["Species", "write_genbank", "write_accession2taxid", "write_gene_describe",
+           "write_kraken_taxonomy", "write_cox1_describe", "write_cox1_taxonomy",
+           "write_otu", "write_cds", "write_protein_result"]
+
+MITO_GENES = ["ND1", "ND2", "COX1", "COX2", "ATP8", "ATP6", "COX3", "ND3", "ND4L",
+              "ND4", "ND5", "ND6", "CYTB"]
+COX1_ALIASES = ["COX1", "cox1", "COI"]
+AMINO = "ACDEFGHIKLMNPQRSTVWY"
+PHYLA = ["Chordata", "Arthropoda", "Mollusca", "Annelida", "Cnidaria", "Nematoda",
+         "Platyhelminthes", "Bryozoa", "Porifera", "Echinodermata"]
+
+
+def open_out(file):
+
+    if file.endswith(".gz"):
+        return gzip.open(file, "wt", compresslevel=1)
+
+    return open(file, "w")
+
+
+class Species(object):
+
+    '''A reproducible set of synthetic taxa: taxid, k..s names and organism'''
+
+    def __init__(self, n, seed=0):
+
+        rng = random.Random(seed)
+        self.taxa = []
+        for i in range(n):
+            genus = "Genus%d" % (i // 4)
+            ranks = ["Eukaryota", rng.choice(PHYLA), "Class%d" % (i // 400),
+                     "Order%d" % (i // 100), "Family%d" % (i // 20), genus,
+                     "%s species%d" % (genus, i)]
+            # some lineages miss ranks, as in the kraken taxonomy
+            if i % 9 == 4:
+                ranks[2] = "unclassified"
+            self.taxa.append((str(10000 + i), ranks))
+
+    def __len__(self):
+
+        return len(self.taxa)
+
+    def lineage(self, i):
+
+        return "|".join("%s__%s" % (r, n) for r, n in zip(RANKS, self.taxa[i][1]))
+
+    def taxid(self, i):
+
+        return self.taxa[i][0]
+
+    def organism(self, i):
+
+        return self.taxa[i][1][-1]
+
+
+def wrap(text, first, width, indent):
+
+    r = [text[:first]]
+    for i in range(first, len(text), width):
+        r.append(indent + text[i:i+width])
+
+    return "\n".join(r)
+
+
+def genbank_record(n, species, rng, length=16000):
+
+    i = n % len(species)
+    organism = species.organism(i)
+    accession = "NC_%06d" % n
+    seq = "".join(rng.choices("acgt", k=length))
+    taxonomy = "; ".join(species.taxa[i][1][:-1]) + "."
+    indent = " " * 21
+
+    r = ["LOCUS       %-16s %11d bp    DNA     circular VRT 01-JAN-2020" % (accession, length),
+         "DEFINITION  %s mitochondrion, complete genome." % organism,
+         "ACCESSION   %s" % accession,
+         "VERSION     %s.1" % accession,
+         "KEYWORDS    RefSeq.",
+         "SOURCE      mitochondrion %s" % organism,
+         "  ORGANISM  %s" % organism,
+         "            %s" % taxonomy,
+         "FEATURES             Location/Qualifiers",
+         "     source          1..%d" % length,
+         '%s/organism="%s"' % (indent, organism),
+         '%s/mol_type="genomic DNA"' % indent,
+         '%s/db_xref="taxon:%s"' % (indent, species.taxid(i))]
+    pos = 1
+    for k, gene in enumerate(MITO_GENES):
+        end = min(pos + 1099, length)
+        if gene == "COX1":
+            gene = COX1_ALIASES[n % 3]
+        location = "%d..%d" % (pos, end) if k % 3 else "complement(%d..%d)" % (pos, end)
+        protein = "M" + "".join(rng.choices(AMINO, k=(end-pos+1)//3-2))
+        r += ["     gene            %s" % location,
+              '%s/gene="%s"' % (indent, gene),
+              "     CDS             %s" % location,
+              '%s/gene="%s"' % (indent, gene),
+              "%s/codon_start=1" % indent,
+              "%s/transl_table=2" % indent,
+              '%s/protein_id="YP_%06d%02d.1"' % (indent, n, k),
+              wrap('%s/translation="%s"' % (indent, protein), 79, 58, indent)]
+        pos = end + 60
+    r.append("ORIGIN")
+    for j in range(0, length, 60):
+        line = " ".join(seq[k:k+10] for k in range(j, min(j+60, length), 10))
+        r.append("%9d %s" % (j+1, line))
+    r.append("//\n")
+
+    return "\n".join(r)
+
+
+def write_genbank(file, records, species, seed=0, length=16000):
+
+    '''Write mitochondrial GenBank records with a COX1 CDS among 13 genes'''
+    rng = random.Random(seed)
+
+    with open_out(file) as fo:
+        for n in range(records):
+            fo.write(genbank_record(n, species, rng, length))
+
+    return file
+
+
+def protein_ids(n):
+
+    return ["XP_%09d.1" % (i * 7) for i in range(n)]
+
+
+def write_accession2taxid(file, n, species, seed=0):
+
+    '''Write a prot.accession2taxid table of n accessions, sorted like NCBI's'''
+    rng = random.Random(seed)
+
+    with open_out(file) as fo:
+        fo.write("accession\taccession.version\ttaxid\tgi\n")
+        for i, protid in enumerate(protein_ids(n)):
+            fo.write("%s\t%s\t%s\t%d\n" % (protid.split(".")[0], protid,
+                     species.taxid(rng.randrange(len(species))), i))
+
+    return file
+
+
+def write_gene_describe(file, n, total, seed=0):
+
+    '''Write a gene.describe.tsv of n protein ids found in an accession2taxid of total'''
+    rng = random.Random(seed)
+    ids = protein_ids(total)
+
+    with open_out(file) as fo:
+        fo.write("#protein_id\ttax_id\torganism\n")
+        for i in sorted(rng.sample(range(total), min(n, total))):
+            fo.write("%s\t-\tOrganism %d\n" % (ids[i], i))
+
+    return file
+
+
+def write_kraken_taxonomy(file, species):
+
+    with open_out(file) as fo:
+        for i in range(len(species)):
+            fo.write("%s\t%s\n" % (species.taxid(i), species.lineage(i)))
+
+    return file
+
+
+def write_cox1_describe(file, n, species, seed=0):
+
+    '''Write a gb2cox1.py cox1.describe.tsv, some taxids are not in the taxonomy'''
+    rng = random.Random(seed)
+
+    with open_out(file) as fo:
+        fo.write("#protein_id\ttax_id\torganism\n")
+        for k in range(n):
+            i = rng.randrange(len(species))
+            taxid = species.taxid(i) if k % 10 else str(900000 + k)
+            fo.write("YP_%08d.1\t%s\t%s\t%s\n" % (k, taxid, species.organism(i),
+                     "\t".join(species.taxa[i][1][:-1])))
+
+    return file
+
+
+def write_cox1_taxonomy(file, n, species, seed=0):
+
+    rng = random.Random(seed)
+
+    with open_out(file) as fo:
+        fo.write("#protein_id\ttax\ttax_id\torganism\n")
+        for k in range(n):
+            i = rng.randrange(len(species))
+            fo.write("YP_%08d.1\t%s\t%s\t%s\n" % (k, species.lineage(i), species.taxid(i),
+                     species.organism(i)))
+
+    return file
+
+
+def write_otu(file, rows, samples, species, seed=0, density=0.3):
+
+    '''Write an OTU table, a row per lineage (repeated lineages included)'''
+    rng = random.Random(seed)
+    values = ["1", "2", "3.0", "0.4", "17", "2.5"]
+
+    with open_out(file) as fo:
+        fo.write("#OTU ID\t%s\n" % "\t".join("S%d" % i for i in range(samples)))
+        for k in range(rows):
+            row = [rng.choice(values) if rng.random() < density else "0" for _ in range(samples)]
+            fo.write("%s\t%s\n" % (species.lineage(rng.randrange(len(species))), "\t".join(row)))
+
+    return file
+
+
+def write_cds(file, n, seed=0):
+
+    '''Write an NCBI cds_from_genomic style fasta for change_ncbi_seq.py'''
+    rng = random.Random(seed)
+
+    with open_out(file) as fo:
+        for i in range(n):
+            pid = "QAB%07d.1" % i
+            attrs = "[gene=%s] " % COX1_ALIASES[i % 3] if i % 4 else "[protein=cytochrome oxidase I] "
+            fo.write(">lcl|MN%07d.1_cds_%s_1 %s[protein_id=%s] [location=1..1545] [gbkey=CDS]\n" % (
+                i, pid, attrs, pid))
+            seq = "".join(rng.choices("ACGT", k=1545))
+            fo.write("\n".join(seq[j:j+70] for j in range(0, len(seq), 70)) + "\n")
+
+    return file
+
+
+def write_protein_result(file, n, species):
+
+    '''Write an NCBI protein search summary naming two thirds of the write_cds ids'''
+    with open_out(file) as fo:
+        for i in range(n):
+            if i % 3 == 0:
+                continue
+            fo.write("%d. cytochrome c oxidase subunit I (mitochondrion) [%s]\n515 aa protein\n"
+                     "QAB%07d.1 GI:%d\n\n" % (i, species.organism(i % len(species)), i, i))
+
+    return file
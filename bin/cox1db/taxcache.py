@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import mmap
+import array
+import bisect
+import struct
+import logging
+
+from cox1db.reader import source_stat, read_tsv
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["compile_taxonomy", "TaxonomyCache", "load_taxonomy"]
+
+CACHE_MAGIC = b"TAXCACHE"
+HEADER = struct.Struct("<I")
+
+
+
+def compile_taxonomy(taxonomy, cache):
+
+    '''Compile a taxid<TAB>lineage file (kraken.taxonomy.gz) into a cache
+
+    Layout after the magic and a json header: sorted uint32 taxids, the
+    uint32 lineage id and the uint32 line order of each taxid, uint64
+    offsets of the lineages and the distinct lineage strings (utf-8)
+    concatenated in id order. As in the text file, the last line of a
+    duplicated taxid wins.
+    '''
+    taxa = {}
+    lineages = {}
+    n = 0
+
+    for taxid, tax in read_tsv(taxonomy, "\t", fields=[0, 1], encoding=None):
+        if not taxid.isdigit():
+            continue
+        if tax not in lineages:
+            lineages[tax] = len(lineages)
+        taxa[int(taxid)] = (lineages[tax], n)
+        n += 1
+
+    taxids = array.array("I", sorted(taxa))
+    ids = array.array("I", [taxa[i][0] for i in taxids])
+    order = array.array("I", [taxa[i][1] for i in taxids])
+    offsets = array.array("Q", [0])
+    for tax in lineages:
+        offsets.append(offsets[-1] + len(tax))
+
+    header = source_stat(taxonomy)
+    header.update({"source": os.path.abspath(taxonomy), "taxa": len(taxids),
+                   "lineages": len(lineages)})
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-(len(CACHE_MAGIC) + HEADER.size + len(header)) % 8)
+
+    temp = cache + ".tmp"
+    with open(temp, "wb") as fo:
+        fo.write(CACHE_MAGIC)
+        fo.write(HEADER.pack(len(header)))
+        fo.write(header)
+        taxids.tofile(fo)
+        ids.tofile(fo)
+        order.tofile(fo)
+        if len(taxids) % 2:
+            fo.write(b"\0" * 4)
+        offsets.tofile(fo)
+        for tax in lineages:
+            fo.write(tax)
+    os.replace(temp, cache)
+    LOG.info("Compiled %s taxa (%s lineages) of %s into %s" % (
+        len(taxids), len(lineages), taxonomy, cache))
+
+    return 0
+
+
+class TaxonomyCache(object):
+
+    def __init__(self, cache):
+
+        self.fh = open(cache, "rb")
+        if self.fh.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            raise ValueError("%s is not a taxonomy cache" % cache)
+        size = HEADER.unpack(self.fh.read(HEADER.size))[0]
+        self.header = json.loads(self.fh.read(size).decode("utf-8"))
+
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+        n = self.header["taxa"]
+        start = len(CACHE_MAGIC) + HEADER.size + size
+        self.taxids = view[start:start+4*n].cast("I")
+        start += 4 * n
+        self.ids = view[start:start+4*n].cast("I")
+        start += 4 * n
+        self.order = view[start:start+4*n].cast("I")
+        start += 4 * n + (4 if n % 2 else 0)
+        m = self.header["lineages"] + 1
+        self.offsets = view[start:start+8*m].cast("Q")
+        self.start = start + 8 * m
+
+    def is_stale(self, taxonomy):
+
+        stat = source_stat(taxonomy)
+
+        return stat["size"] != self.header["size"] or stat["mtime"] != self.header["mtime"]
+
+    def locate(self, taxid):
+
+        if not isinstance(taxid, int):
+            if not taxid.isdigit():
+                return -1
+            taxid = int(taxid)
+        i = bisect.bisect_left(self.taxids, taxid)
+        if i < len(self.taxids) and self.taxids[i] == taxid:
+            return i
+
+        return -1
+
+    def find(self, taxid):
+
+        i = self.locate(taxid)
+
+        return self.ids[i] if i >= 0 else -1
+
+    def select(self, taxids):
+
+        '''Return {taxid: lineage} of the given taxids in taxonomy file order'''
+        r = []
+        for taxid in taxids:
+            i = self.locate(taxid)
+            if i >= 0:
+                r.append((self.order[i], taxid, self.lineage(self.ids[i])))
+        r.sort()
+
+        return {taxid: tax for _, taxid, tax in r}
+
+    def lineage(self, lid):
+
+        return self.mm[self.start+self.offsets[lid]:self.start+self.offsets[lid+1]].decode("utf-8")
+
+    def get(self, taxid, default=None):
+
+        lid = self.find(taxid)
+        if lid < 0:
+            return default
+
+        return self.lineage(lid)
+
+    def __contains__(self, taxid):
+
+        return self.find(taxid) >= 0
+
+    def close(self):
+
+        self.taxids.release()
+        self.ids.release()
+        self.order.release()
+        self.offsets.release()
+        self.mm.close()
+        self.fh.close()
+
+
+def load_taxonomy(taxonomy, cache=None):
+
+    '''Open the cache of taxonomy, (re)compiling it when missing or stale'''
+    cache = cache or "%s.cache" % taxonomy
+
+    if os.path.exists(cache):
+        r = TaxonomyCache(cache)
+        if not r.is_stale(taxonomy):
+            return r
+        r.close()
+        LOG.info("Taxonomy cache %s is stale, recompiling" % cache)
+    compile_taxonomy(taxonomy, cache)
+
+    return TaxonomyCache(cache)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import gzip
+import queue
+import shutil
+import logging
+import threading
+import subprocess
+
+from cox1db import stats
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["open_output", "output_name", "output_compress", "add_output_args"]
+
+BUFFER_SIZE = 1 << 22
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESS = {"gzip": ".gz", "zstd": ".zst"}
+TOOLS = {
+    "gzip": [("pigz", ["-c", "-%s" % GZIP_LEVEL, "-p", "{}"]), ("igzip", ["-c", "-1", "-T", "{}"])],
+    "zstd": [("zstd", ["-c", "-q", "-%s" % ZSTD_LEVEL, "-T{}"])],
+}
+
+
+class ProcessWriter(object):
+
+    '''Write through the stdin of an external compressor (pigz/igzip/zstd)'''
+
+    def __init__(self, fh, exe, args, threads):
+
+        self.proc = subprocess.Popen([exe] + [i.format(threads) for i in args],
+            stdin=subprocess.PIPE, stdout=fh, bufsize=BUFFER_SIZE)
+        self.name = exe
+
+    def write(self, data):
+
+        return self.proc.stdin.write(data)
+
+    def close(self):
+
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        code = self.proc.wait()
+        if code != 0:
+            raise IOError("Failed to compress with %s (exit %s)" % (self.name, code))
+
+
+class ThreadedWriter(object):
+
+    '''Collect text in large buffers, encode, compress and write them in a background thread
+
+    The caller only appends strings, so writing (and zlib/zstd compressing,
+    which release the GIL) overlaps with the parsing in the main thread.
+    '''
+
+    def __init__(self, fh, raw=None, size=BUFFER_SIZE, depth=4):
+
+        self.fh = fh
+        self.raw = raw
+        self.size = size
+        self.buffer = []
+        self.length = 0
+        self.nbytes = 0
+        self.error = None
+        self.queue = queue.Queue(depth)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error:
+                continue
+            try:
+                data = "".join(chunk).encode("utf-8")
+                self.nbytes += len(data)
+                self.fh.write(data)
+            except Exception as e:
+                self.error = e
+
+    def write(self, text):
+
+        self.buffer.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+
+    def writelines(self, lines):
+
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+
+        if self.error:
+            raise self.error
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = []
+            self.length = 0
+
+    def close(self):
+
+        if self.thread is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.fh is not self.raw:
+            self.fh.close()
+        if self.raw is sys.stdout.buffer:
+            self.raw.flush()
+        elif self.raw is not None:
+            self.raw.close()
+        stats.add("write_output", nbytes=self.nbytes)
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+def find_tool(compress):
+
+    if compress == "gzip" and os.environ.get("COX1DB_GZIP") == "python":
+        return None, None
+    for exe, args in TOOLS[compress]:
+        path = shutil.which(exe)
+        if path:
+            return path, args
+
+    return None, None
+
+
+def python_compressor(raw, compress, threads):
+
+    if compress == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL)
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd output needs the zstd program or the zstandard module")
+
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=threads).stream_writer(raw, closefd=False)
+
+
+def open_output(file=None, compress=None, threads=None):
+
+    '''Open a buffered text sink on file (None or "-" for stdout)
+
+    compress is None, "gzip" or "zstd"; when None it follows the extension
+    of file (.gz, .zst). Compression goes through pigz/igzip or zstd when on
+    the PATH (set COX1DB_GZIP=python to use zlib), otherwise through zlib or
+    the zstandard module in the writer thread.
+    '''
+    compress = output_compress(file, compress)
+    if compress is not None and compress not in COMPRESS:
+        raise ValueError("Unknown compression %s, choose from %s" % (compress, ", ".join(COMPRESS)))
+
+    if not file or file == "-":
+        sys.stdout.flush()
+        raw = sys.stdout.buffer
+    else:
+        raw = open(file, "wb")
+    if compress is None:
+        return ThreadedWriter(raw, raw)
+
+    threads = threads or os.cpu_count() or 1
+    exe, args = find_tool(compress)
+    if exe:
+        fh = ProcessWriter(raw, exe, args, threads)
+    else:
+        fh = python_compressor(raw, compress, threads)
+
+    return ThreadedWriter(fh, raw)
+
+
+def output_name(file, compress=None):
+
+    '''Name of a side output: file with the suffix of compress added'''
+    suffix = COMPRESS.get(compress)
+    if suffix and not file.endswith(suffix):
+        return file + suffix
+
+    return file
+
+
+def output_compress(output=None, compress=None):
+
+    '''Compression of the outputs: compress, else the one of the output extension'''
+    if compress is not None:
+        return None if compress == "none" else compress
+    for name, suffix in COMPRESS.items():
+        if output and output.endswith(suffix):
+            return name
+
+    return None
+
+
+def add_output_args(parser):
+
+    parser.add_argument("-o", "--output", metavar="FILE", type=str, default="-",
+        help="Output file, gzip or zstd compressed by a .gz or .zst suffix, default=stdout.")
+    parser.add_argument("-z", "--compress", choices=["none", "gzip", "zstd"], default=None,
+        help="Compress the output and the side files (.gz/.zst added to their names), default=by the --output suffix.")
+
+    return parser
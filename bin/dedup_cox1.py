@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import logging
+import argparse
+import collections
+
+from cox1db.reader import read_tsv
+from cox1db.fasta import read_fasta
+from cox1db.lineage import LineageTable, common_lineage
+from cox1db.seqhash import seq_digest, build_seqhash, SeqHash
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+TAXON = re.compile(r"\[taxon=([^\]]*)\]")
+
+
+def parse_header(header):
+
+    '''Return (protein_id, taxon) of a gb2cox1.py fasta header'''
+    match = TAXON.search(header)
+
+    return header.split()[0].split("|")[0], match.group(1) if match else "-"
+
+
+def read_cox1_taxonomy(file):
+
+    '''protein_id -> (tax, tax_id) of cox1.taxonomy.tsv'''
+    r = {}
+
+    for line in read_tsv(file, "\t", comment=None, fields=[0, 1, 2]):
+        if "#" in line[0]:
+            continue
+        r[line[0]] = (line[1], line[2])
+
+    return r
+
+
+def group_sequences(file):
+
+    '''Group identical sequences: digest -> [header, seq, [(protein_id, taxon)]]'''
+    groups = collections.OrderedDict()
+    n = 0
+
+    for header, seq in read_fasta(file):
+        n += 1
+        digest = seq_digest(seq)
+        if digest not in groups:
+            groups[digest] = [header, seq, []]
+        groups[digest][2].append(parse_header(header))
+
+    LOG.info("Collapsed %s sequences of %s into %s" % (n, file, len(groups)))
+
+    return groups
+
+
+def dedup_cox1(file, taxonomy=None, prefix="cox1.nr"):
+
+    with stats.stage("group", nbytes=os.path.getsize(file)) as st:
+        groups = group_sequences(file)
+        st.records = len(groups)
+    with stats.stage("read_taxonomy") as st:
+        taxa = read_cox1_taxonomy(taxonomy) if taxonomy else {}
+        st.records = len(taxa)
+    stats.size("taxonomy", taxa)
+    table = LineageTable()
+    disagree = 0
+
+    fa = open("%s.fasta" % prefix, "w")
+    fm = open("%s.members.tsv" % prefix, "w")
+    fm.write("#representative\tmembers\tprotein_ids\ttax_ids\ttax\n")
+    for header, seq, members in groups.values():
+        ids = [i[0] for i in members]
+        taxids = []
+        lineages = []
+        for protid, taxon in members:
+            tax, taxid = taxa.get(protid, ("", taxon))
+            if taxid not in taxids:
+                taxids.append(taxid)
+            if tax and tax not in lineages:
+                lineages.append(tax)
+
+        tax = "-"
+        if len(lineages) == 1:
+            tax = lineages[0]
+        elif lineages:
+            disagree += 1
+            tax = common_lineage(table, [table.intern(i) for i in lineages]) or "-"
+
+        fa.write(">%s\n%s\n" % (header, seq))
+        fm.write("%s\t%s\t%s\t%s\t%s\n" % (ids[0], len(ids), ",".join(ids), ",".join(taxids), tax))
+    fm.close()
+    fa.close()
+    LOG.info("%s representatives hold members of different lineages" % disagree)
+
+    with stats.stage("seqhash", records=len(groups)):
+        build_seqhash(((digest, group[2][0][0].encode("utf-8")) for digest, group in groups.items()),
+                      "%s.seqhash" % prefix, {"source": file})
+
+    return 0
+
+
+def lookup_seqs(file, index):
+
+    '''Print the representative of each sequence of file, - when not in the index'''
+    idx = SeqHash(index)
+
+    for header, seq in read_fasta(file):
+        print("%s\t%s" % (header.split()[0], idx.get(seq, "-")))
+    idx.close()
+
+    return 0
+
+
+def add_help_args(parser):
+
+    parser.add_argument("input", metavar="FILE", type=str,
+        help="Input cox1 sequences(cox1.fasta or cox1.pep.fasta), or query sequences with --lookup.")
+    parser.add_argument("-tax", "--taxonomy", metavar="FILE", type=str, default=None,
+        help="cox1.taxonomy.tsv.gz, used for the lineage of each representative.")
+    parser.add_argument("-p", "--prefix", metavar="STR", type=str, default="cox1.nr",
+        help="Output prefix, default=cox1.nr.")
+    parser.add_argument("--lookup", metavar="FILE", type=str, default=None,
+        help="Look up the input sequences in a PREFIX.seqhash index.")
+
+    add_stats_args(parser)
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     dedup_cox1.py: Collapse identical cox1 sequences into one representative.
+
+     Writes the representatives (first occurrence) to PREFIX.fasta, their
+     members, taxids and the common lineage of the members to
+     PREFIX.members.tsv and a sequence hash index to PREFIX.seqhash.
+
+attention:
+     dedup_cox1.py cox1.fasta --taxonomy cox1.taxonomy.tsv.gz --prefix cox1.nr
+     dedup_cox1.py cox1.pep.fasta --taxonomy cox1.taxonomy.tsv.gz --prefix cox1.pep.nr
+     dedup_cox1.py query.fasta --lookup cox1.nr.seqhash >query.hits.tsv
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    with instrument(args):
+        if args.lookup:
+            lookup_seqs(args.input, args.lookup)
+            return 0
+
+        dedup_cox1(args.input, args.taxonomy, args.prefix)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -3,10 +3,17 @@
 
 import os
 import sys
-import gzip
 import logging
 import argparse
 
+from cox1db.reader import read_tsv
+from cox1db.taxcache import compile_taxonomy, load_taxonomy
+from cox1db.lineage import LineageTable
+from cox1db.client import LookupClient
+from cox1db.writer import open_output, add_output_args
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "v1.0.0"
@@ -15,34 +22,20 @@ __email__ = "invicoun@foxmail.com"
 __all__ = []
 
 
-def read_tsv(file, sep=None):
-
-    if file.endswith(".gz"):
-        fh = gzip.open(file)
-    else:
-        fh = open(file)
-
-    for line in fh:
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
-        line = line.strip()
-
-        if not line or line.startswith("#"):
-            continue
-
-        yield line.split(sep)
+def read_gene_desc(file):
 
-    fh.close()
+    return index_gene_desc(read_tsv(file, "\t"))
 
 
-def read_gene_desc(file):
+def index_gene_desc(lines):
 
+    '''Index describe rows (protein_id, tax_id, organism[, taxonomy...])'''
     r = {}
     taxids = set()
     genus = set()
     species = set()
 
-    for line in read_tsv(file, "\t"):
+    for line in lines:
         if len(line) <= 3:
             r[line[0]] = line[1::]
             if line[-1] != "-":
@@ -57,28 +50,68 @@ def read_gene_desc(file):
     return r, taxids, genus, species
 
 
-def desc2tax(desc, taxonomy):
+def index_rank(lineages, ranks=("g", "s")):
+
+    '''Index lineages as rank -> "x__name" -> lineage, later lineages win'''
+    r = {i: {} for i in ranks}
+    table = LineageTable()
+
+    for tax in lineages:
+        lid = table.intern(tax)
+        for rank in ranks:
+            name = table.rank(lid, rank)
+            if name and name != "unclassified":
+                r[rank]["%s__%s" % (rank, name)] = tax
+
+    return r
+
 
-    data, taxids, genus, species = read_gene_desc(desc)
+def read_taxonomy(taxonomy, taxids, cache=None, server=None):
 
     r = {}
-    for line in read_tsv(taxonomy, "\t"):
-        if line[0] not in taxids:
+    if server:
+        with LookupClient(server) as client:
+            for taxid, tax in client.select(taxids):
+                r[taxid] = tax.split(".")[0]
+        return r
+    if cache:
+        tc = load_taxonomy(taxonomy, cache)
+        for taxid, tax in tc.select(taxids).items():
+            r[taxid] = tax.split(".")[0]
+        tc.close()
+        return r
+
+    keys = set(i.encode("utf-8") for i in taxids)
+    for taxid, tax in read_tsv(taxonomy, "\t", fields=[0, 1], encoding=None):
+        if taxid not in keys:
             continue
-        r[line[0]] = line[1].split(".")[0]
+        r[taxid.decode("utf-8")] = tax.decode("utf-8").split(".")[0]
 
-    dgs = {}
-    for i in r:
+    return r
+
+
+def annotate_desc(desc, taxonomy, cache=None, server=None):
+
+    '''Yield [protein_id, tax, tax_id, organism] of an index_gene_desc result'''
+    data, taxids, genus, species = desc
+
+    with stats.stage("read_taxonomy", nbytes=os.path.getsize(taxonomy) if taxonomy else 0) as st:
+        r = read_taxonomy(taxonomy, taxids, cache, server)
+        st.records = len(r)
+    stats.size("taxids", taxids)
+    stats.size("taxonomy", r)
+
+    with stats.stage("index_rank", records=len(r)):
+        index = index_rank(r.values())
+        dgs = {}
         for j in species:
-            if j in r[i]:
-                dgs[j] = r[i]
-                break
+            if j in index["s"]:
+                dgs[j] = index["s"][j]
         for j in genus:
-            if j in r[i]:
-                dgs[j] = r[i].split("|s__")[0]
-                break
+            if j in index["g"]:
+                dgs[j] = index["g"][j].split("|s__")[0]
+    stats.size("dgs", dgs)
 
-    print("#protein_id\ttax\ttax_id\torganism")
     for i in data:
         taxid = data[i][0]
         skey = data[i][-1]
@@ -98,17 +131,37 @@ def desc2tax(desc, taxonomy):
             if data[i][1] != "-":
                 tax = "%s|s__%s" % (tax, data[i][1])
 
-        print("%s\t%s\t%s\t%s" % (i, tax, taxid, data[i][1]))
+        yield [i, tax, taxid, data[i][1]]
+
+
+def desc2tax(desc, taxonomy, cache=None, server=None, output="-", compress=None):
+
+    with stats.stage("read_desc", nbytes=os.path.getsize(desc)) as st:
+        data = read_gene_desc(desc)
+        st.records = len(data[0])
+    stats.size("protein_ids", data[0])
+
+    with stats.stage("annotate", records=len(data[0])), open_output(output, compress) as fo:
+        fo.write("#protein_id\ttax\ttax_id\torganism\n")
+        for line in annotate_desc(data, taxonomy, cache, server):
+            fo.write("%s\n" % "\t".join(line))
 
     return 0
 
 
 def add_help_args(parser):
 
-    parser.add_argument("input", metavar="FILE", type=str,
+    parser.add_argument("input", nargs="?", metavar="FILE", type=str,
         help="Input sequence and taxid corresponding list.")
-    parser.add_argument("-tax", "--taxonomy", metavar="FILE", type=str, required=True,
+    parser.add_argument("-tax", "--taxonomy", metavar="FILE", type=str, default=None,
         help="input taxonomy file(kraken.taxonomy.gz).")
+    parser.add_argument("-c", "--cache", metavar="FILE", type=str, default=None,
+        help="Compiled taxonomy cache, (re)built when missing or older than --taxonomy.")
+    parser.add_argument("--server", metavar="FILE", type=str, default=None,
+        help="Look the taxids up in a running cox1_server.py (its Unix socket) instead of --taxonomy.")
+
+    add_output_args(parser)
+    add_stats_args(parser)
 
     return parser
 
@@ -129,6 +182,10 @@ name:
 
 attention:
      desc2tax.py cox1.describe.tsv --taxonomy kraken.taxonomy.gz >cox1.taxonomy.tsv
+     desc2tax.py --taxonomy kraken.taxonomy.gz --cache kraken.taxonomy.cache
+     desc2tax.py cox1.describe.tsv --taxonomy kraken.taxonomy.gz --cache kraken.taxonomy.cache >cox1.taxonomy.tsv
+     desc2tax.py cox1.describe.tsv --server cox1.sock >cox1.taxonomy.tsv
+     desc2tax.py cox1.describe.tsv --taxonomy kraken.taxonomy.gz -o cox1.taxonomy.tsv.gz
 
 version: %s
 contact:  %s <%s>\
@@ -136,7 +193,16 @@ contact:  %s <%s>\
 
     args = add_help_args(parser).parse_args()
 
-    desc2tax(args.input, args.taxonomy)
+    if not args.taxonomy and not args.server:
+        parser.error("the following arguments are required: -tax/--taxonomy or --server")
+    with instrument(args):
+        if not args.input:
+            if not args.cache:
+                parser.error("the following arguments are required: FILE")
+            compile_taxonomy(args.taxonomy, args.cache)
+            return 0
+
+        desc2tax(args.input, args.taxonomy, args.cache, args.server, args.output, args.compress)
 
 
 if __name__ == "__main__":
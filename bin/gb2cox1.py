@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
+import re
 import sys
-import gzip
+import shutil
 import logging
 import argparse
+import tempfile
+import collections
+import multiprocessing
 
-from Bio import SeqIO
+from cox1db.reader import read_chunks
+from cox1db.writer import open_output, output_name, output_compress, add_output_args
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
 
 LOG = logging.getLogger(__name__)
 
@@ -16,18 +24,116 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "invicoun@foxmail.com"
 __all__ = []
 
+COX1_NAMES = ["COX1", "cox1", "COI"]
+COX1_QUALIFIER = re.compile(
+    br'^ {21}/(?:gene|gene_synonym|locus_tag)="(?:%s)"\s*$' % "|".join(COX1_NAMES).encode(),
+    re.M)
+FEATURE_START = re.compile(br"^ {5}(\S+)", re.M)
+SECTION_START = re.compile(br"^\S", re.M)
+SHARD_SUFFIX = [".fa", ".pep.fasta", ".describe.tsv"]
 
-def get_cox1(file):
 
-    if file.endswith(".gz"):
-        fh = gzip.open(file)
-    else:
-        fh = open(file)
+def read_genbank(file):
 
-    fo = open("cox1.pep.fasta", "w")
-    fd = open("cox1.describe.tsv", "w")
-    fd.write("#protein_id\ttax_id\torganism\n")
-    for record in SeqIO.parse(fh, "genbank"):
+    '''Split a (gzip) GenBank file into raw records ending with //'''
+    rest = b""
+
+    for chunk in read_chunks(file):
+        records = (rest + chunk).split(b"\n//")
+        rest = records.pop()
+        for record in records:
+            yield record.lstrip(b"\r\n") + b"\n//\n"
+    rest = rest.strip()
+    if rest and rest != b"//":
+        yield rest + b"\n//\n"
+
+
+def trim_features(record):
+
+    '''Keep the source features and the CDS features naming COX1
+
+    Returns (None, None) when the record has no CDS with a COX1 gene,
+    gene_synonym or locus_tag qualifier. Otherwise returns the record text
+    with the FEATURES block cut down to the features get_cox1 reads and an
+    empty ORIGIN, and the upper case sequence read from ORIGIN (None if the
+    record has no ORIGIN).
+    '''
+    if not COX1_QUALIFIER.search(record):
+        return None, None
+
+    seq = None
+    origin = record.find(b"\nORIGIN")
+    if origin >= 0:
+        end = record.find(b"\n//", origin)
+        seq = record[record.find(b"\n", origin+1):end]
+        seq = seq.translate(None, b" \t\r\n0123456789").upper()
+        record = record[:origin+1] + b"ORIGIN\n//\n"
+
+    start = record.find(b"\nFEATURES")
+    if start < 0:
+        return None, None
+    start = record.find(b"\n", start+1) + 1
+    end = SECTION_START.search(record, start).start()
+
+    r = [record[:start]]
+    found = False
+    features = list(FEATURE_START.finditer(record, start, end))
+    for i, match in enumerate(features):
+        key = match.group(1)
+        stop = features[i+1].start() if i+1 < len(features) else end
+        if key == b"CDS" and COX1_QUALIFIER.search(record, match.start(), stop):
+            found = True
+        elif key != b"source":
+            continue
+        r.append(record[match.start():stop])
+    if not found:
+        return None, None
+    r.append(record[end:])
+
+    return b"".join(r), seq
+
+
+def parse_record(record):
+
+    '''Parse a raw GenBank record, None if it has no COX1 CDS'''
+    record, seq = trim_features(record)
+    if record is None:
+        return None
+    from Bio import SeqIO
+    from Bio.Seq import Seq
+
+    record = SeqIO.read(io.StringIO(record.decode("utf-8")), "genbank")
+    if seq is not None:
+        record.seq = Seq(seq.decode("ascii"))
+
+    return record
+
+
+def read_cox1_records(file):
+
+    '''Parse only the GenBank records that carry a COX1 CDS'''
+    n = 0
+    m = 0
+
+    for record in read_genbank(file):
+        n += 1
+        record = parse_record(record)
+        if record is None:
+            continue
+        m += 1
+        yield record
+
+    stats.add("extract", records=n)
+    LOG.info("Parsed %s of %s records in %s" % (m, n, file))
+
+
+def iter_cox1(records):
+
+    '''Yield (ncid, gene, organism, taxon, taxonomy, seq, protein) of each COX1 CDS
+
+    protein is None when the CDS has no translation.
+    '''
+    for record in records:
         organism = record.annotations["organism"]
         taxonomy = record.annotations["taxonomy"]
         taxon = ""
@@ -48,7 +154,7 @@ def get_cox1(file):
             else:
                 gene_id = ""
 
-            if gene_id not in ["COX1", "cox1", "COI"]:
+            if gene_id not in COX1_NAMES:
                 continue
 
             if "coded_by" in gene_desc:
@@ -58,23 +164,143 @@ def get_cox1(file):
             else:
                 ncid = ""
 
-            seq = genes.extract(record.seq)
-            print(">%s|%s [organism=%s] [taxon=%s]\n%s" % (ncid, gene_id.upper(), organism, taxon, seq))
-            fd.write("%s\t%s\t%s\t%s\n" % (ncid, taxon, organism, "\t".join(taxonomy)))
+            protein = None
             if "translation" in gene_desc:
                 protein = str(gene_desc["translation"][0])
-                fo.write(">%s|%s [organism=%s] [taxon=%s]\n%s\n" % (ncid, gene_id.upper(), organism, taxon, protein))
+            yield ncid, gene_id.upper(), organism, taxon, taxonomy, genes.extract(record.seq), protein
 
-    fd.close()
-    fo.close()
+
+def write_cox1(records, fa, fo, fd):
+
+    '''Write the COX1 CDS (fa), proteins (fo) and descriptions (fd) of records'''
+    for ncid, gene, organism, taxon, taxonomy, seq, protein in iter_cox1(records):
+        fa.write(">%s|%s [organism=%s] [taxon=%s]\n%s\n" % (ncid, gene, organism, taxon, seq))
+        fd.write("%s\t%s\t%s\t%s\n" % (ncid, taxon, organism, "\t".join(taxonomy)))
+        if protein is not None:
+            fo.write(">%s|%s [organism=%s] [taxon=%s]\n%s\n" % (ncid, gene, organism, taxon, protein))
+
+    return 0
+
+
+def get_cox1(file, fa, fo, fd):
+
+    return write_cox1(read_cox1_records(file), fa, fo, fd)
+
+
+def get_cox1_batch(records):
+
+    '''Worker: extract a batch of raw records, return the three outputs'''
+    outputs = [io.StringIO(), io.StringIO(), io.StringIO()]
+    records = [parse_record(i) for i in records]
+    write_cox1([i for i in records if i is not None], *outputs)
+
+    return [i.getvalue() for i in outputs]
+
+
+def get_cox1_tuples(records):
+
+    '''Worker: extract a batch of raw records, return the iter_cox1 tuples'''
+    records = [parse_record(i) for i in records]
+
+    return [i[:5] + (str(i[5]), i[6]) for i in iter_cox1([j for j in records if j is not None])]
+
+
+def read_batches(file, batch):
+
+    r = []
+    for record in read_genbank(file):
+        if not COX1_QUALIFIER.search(record):
+            continue
+        r.append(record)
+        if len(r) >= batch:
+            yield r
+            r = []
+    if r:
+        yield r
+
+
+def split_cox1(file, outputs, pool, batch=200, inflight=8):
+
+    '''Extract one GenBank file by batches of records over a process pool
+
+    At most inflight batches are queued or running, results are written in
+    the order of the records in file.
+    '''
+    pending = collections.deque()
+
+    for records in read_batches(file, batch):
+        if len(pending) >= inflight:
+            for fh, text in zip(outputs, pending.popleft().get()):
+                fh.write(text)
+        pending.append(pool.apply_async(get_cox1_batch, (records,)))
+    while pending:
+        for fh, text in zip(outputs, pending.popleft().get()):
+            fh.write(text)
 
     return 0
 
 
-def gb2cox1(files):
+def get_cox1_shard(args):
 
-    for file in files:
-        get_cox1(file)
+    '''Worker: extract one GenBank file into its own shard files'''
+    n, file, tmpdir = args
+    prefix = os.path.join(tmpdir, "%06d" % n)
+    shards = [prefix + i for i in SHARD_SUFFIX]
+
+    with open(shards[0], "w") as fa, open(shards[1], "w") as fo, open(shards[2], "w") as fd:
+        get_cox1(file, fa, fo, fd)
+
+    return shards
+
+
+def merge_shard(shards, outputs):
+
+    for shard, fh in zip(shards, outputs):
+        with open(shard) as fi:
+            shutil.copyfileobj(fi, fh, 1 << 20)
+        os.remove(shard)
+
+    return 0
+
+
+def gb2cox1(files, threads=1, split=False, batch=200, inflight=0,
+            pep="cox1.pep.fasta", describe="cox1.describe.tsv", output="-", compress=None):
+
+    # fork the workers before open_output starts the writer threads
+    pool = None
+    if threads > 1:
+        pool = multiprocessing.Pool(threads if split or len(files) == 1 else min(threads, len(files)))
+
+    compress = output_compress(output, compress)
+    fa = open_output(output, compress)
+    fo = open_output(output_name(pep, compress), compress)
+    fd = open_output(output_name(describe, compress), compress)
+    fd.write("#protein_id\ttax_id\torganism\n")
+    outputs = [fa, fo, fd]
+
+    if pool is None:
+        for file in files:
+            with stats.stage("extract", nbytes=os.path.getsize(file)):
+                get_cox1(file, fa, fo, fd)
+    elif split or len(files) == 1:
+        for file in files:
+            with stats.stage("extract", nbytes=os.path.getsize(file)):
+                split_cox1(file, outputs, pool, batch, inflight or 2*threads)
+    else:
+        tmpdir = tempfile.mkdtemp(prefix="gb2cox1.", dir=os.path.dirname(os.path.abspath(describe)))
+        tasks = [(n, file, tmpdir) for n, file in enumerate(files)]
+        # imap hands the shards back in input order, merge them as they come
+        for shards in pool.imap(get_cox1_shard, tasks):
+            with stats.stage("merge", nbytes=sum(os.path.getsize(i) for i in shards)):
+                merge_shard(shards, outputs)
+        os.rmdir(tmpdir)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    fd.close()
+    fo.close()
+    fa.close()
 
     return 0
 
@@ -83,6 +309,17 @@ def add_help_args(parser):
 
     parser.add_argument("genbank", nargs="+", metavar="FILE", type=str,
         help="Input the mitochondrial genebank file.")
+    parser.add_argument("-t", "--threads", metavar="INT", type=int, default=1,
+        help="Number of processes, input files are spread over them, default=1.")
+    parser.add_argument("--split", action="store_true",
+        help="Split each file into batches of records for the processes (default with a single file).")
+    parser.add_argument("--batch", metavar="INT", type=int, default=200,
+        help="Records per batch with --split, default=200.")
+    parser.add_argument("--inflight", metavar="INT", type=int, default=0,
+        help="Maximum batches held in memory with --split, default=2*threads.")
+
+    add_output_args(parser)
+    add_stats_args(parser)
 
     return parser
 
@@ -103,6 +340,9 @@ name:
 
 attention:
      gb2cox1.py mitochondrion.1.*.gbff.gz >COX1.fa
+     gb2cox1.py mitochondrion.*.gbff.gz --threads 8 >COX1.fa
+     gb2cox1.py organelle.gbff.gz --threads 8 --batch 200 >COX1.fa
+     gb2cox1.py mitochondrion.*.gbff.gz --threads 8 -o COX1.fa.gz   # also cox1.pep.fasta.gz, cox1.describe.tsv.gz
 
 version: %s
 contact:  %s <%s>\
@@ -110,7 +350,9 @@ contact:  %s <%s>\
 
     args = add_help_args(parser).parse_args()
 
-    gb2cox1(args.genbank)
+    with instrument(args):
+        gb2cox1(args.genbank, args.threads, args.split, args.batch, args.inflight,
+                output=args.output, compress=args.compress)
 
 
 if __name__ == "__main__":
@@ -2,14 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import os
-import re
 import sys
-import gzip
+import math
+import zlib
+import shutil
 import logging
 import argparse
+import warnings
+import resource
+import tempfile
 
 import numpy as np
-from collections import OrderedDict
+
+from cox1db.reader import read_lines
+from cox1db.lineage import LineageTable
+from cox1db.client import LookupClient
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
 
 LOG = logging.getLogger(__name__)
 
@@ -19,103 +28,345 @@ __email__ = "invicoun@foxmail.com"
 __all__ = []
 
 
-def read_tsv(file, sep="\t"):
+BLOCK_ROWS = 20000
+SPARSE_DENSITY = 0.3
+MAX_PARTS = 1000
 
-    if file.endswith(".gz"):
-        fh = gzip.open(file)
-    else:
-        fh = open(file)
 
-    for line in fh:
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
-        line = line.strip()
+class ColumnSparse(object):
 
-        if not line:
-            continue
+    '''Taxa x samples matrix stored by column (CSC): only nonzero cells'''
+
+    def __init__(self, rows, cols, values, shape):
+
+        order = np.lexsort((rows, cols))
+        self.shape = shape
+        self.indices = rows[order]
+        self.data = values[order]
+        self.indptr = np.zeros(shape[1]+1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=shape[1]), out=self.indptr[1:])
+
+    def column(self, i):
+
+        start, end = self.indptr[i], self.indptr[i+1]
+
+        return self.indices[start:end], self.data[start:end]
+
+
+def check_rows(values, width, numbers, file):
+
+    '''Raise a ValueError naming the first row without width numeric cells'''
+    for value, n in zip(values, numbers):
+        cells = value.split(b"\t")
+        if len(cells) != width:
+            raise ValueError("Line %s of %s has %s abundances for %s samples: %r" % (
+                n, file, len(cells), width, value.decode("utf-8")))
+        for cell in cells:
+            try:
+                float(cell)
+            except ValueError:
+                raise ValueError("Line %s of %s has a non numeric abundance %r" % (
+                    n, file, cell.decode("utf-8")))
+
+
+def parse_block(values, width, numbers, file):
+
+    '''Float matrix of the tab separated abundances of each row, width cells a row'''
+    if any(i.count(b"\t") != width - 1 for i in values):
+        check_rows(values, width, numbers, file)
+    try:
+        with warnings.catch_warnings():
+            # fromstring stops at a cell it cannot read (a warning, an error in newer NumPy)
+            warnings.simplefilter("ignore", DeprecationWarning)
+            matrix = np.fromstring(b"\t".join(values).decode("utf-8"), dtype=float, sep="\t")
+    except ValueError:
+        matrix = None
+    if matrix is None or matrix.size != len(values) * width:
+        check_rows(values, width, numbers, file)
+        matrix = np.array(b"\t".join(values).split(b"\t")).astype(float)
 
-        yield line.split(sep)
+    return matrix.reshape(len(values), width)
 
-    fh.close()
 
+def read_otu_blocks(file, index, block=BLOCK_ROWS, all_ids=False):
 
-def read_otu(file):
+    '''Yield (samples, taxon ids, float matrix) for blocks of rows of the table
 
-    data = {}
+    Rows whose OTU ID is not a lineage are skipped unless all_ids.
+    '''
     samples = []
+    rows = []
+    values = []
+    numbers = []
     n = 0
 
-    for line in read_tsv(file, sep="\t"):
+    for line in read_lines(file, comment=None):
         n += 1
-        if line[0].startswith("#") or n == 1:
-            samples = line[1::]
+        taxon, _, value = line.partition(b"\t")
+        if taxon.startswith(b"#") or n == 1:
+            samples = [i.decode("utf-8") for i in value.split(b"\t")]
             continue
-        if "k__" not in line[0]:
+        if b"k__" not in taxon and not all_ids:
             continue
-        if line[0] not in data:
-            data[line[0]] = np.array(line[1::]).astype(float)
+        taxon = taxon.decode("utf-8")
+        if taxon not in index:
+            index[taxon] = len(index)
+        rows.append(index[taxon])
+        values.append(value)
+        numbers.append(n)
+        if len(values) >= block:
+            yield samples, np.array(rows), parse_block(values, len(samples), numbers, file)
+            rows = []
+            values = []
+            numbers = []
+    if values or n:
+        yield samples, np.array(rows, dtype=np.int64), \
+            parse_block(values, len(samples), numbers, file) if values else None
+
+
+def read_otu(file, mode="auto", block=BLOCK_ROWS, all_ids=False):
+
+    '''Read the otu table into (samples, taxa, matrix)
+
+    Rows of the same taxon are summed in file order and taxa keep the order
+    of their first row. matrix is a dense taxa x samples array, or with
+    mode="sparse" a ColumnSparse holding only the nonzero cells; "auto"
+    picks sparse when the first block of rows is at most SPARSE_DENSITY
+    nonzero.
+    '''
+    index = {}
+    samples = []
+    rows = []
+    dense = []
+    sparse = [[], [], []]
+
+    for samples, ids, values in read_otu_blocks(file, index, block, all_ids):
+        if values is None:
+            continue
+        if mode == "auto":
+            density = np.count_nonzero(values) / max(values.size, 1)
+            mode = "sparse" if density <= SPARSE_DENSITY else "dense"
+            LOG.info("%.1f%% of the abundances are nonzero, using the %s matrix" % (100*density, mode))
+        if mode == "dense":
+            rows.append(ids)
+            dense.append(values)
         else:
-            data[line[0]] = data[line[0]] + np.array(line[1::]).astype(float)
+            r, c = np.nonzero(values)
+            sparse[0].append(ids[r])
+            sparse[1].append(c)
+            sparse[2].append(values[r, c])
 
-    return samples, data
+    taxa = list(index)
+    if mode == "sparse" and sparse[0]:
+        return samples, taxa, merge_sparse(sparse, (len(taxa), len(samples)))
+    if not dense:
+        return samples, taxa, np.zeros((0, len(samples)))
+    matrix = np.vstack(dense)
+    rows = np.concatenate(rows)
 
+    if len(taxa) < len(rows):
+        # add.at adds the rows in file order, as the old per-row sum did
+        merged = np.zeros((len(taxa), matrix.shape[1]))
+        np.add.at(merged, rows, matrix)
+        matrix = merged
 
-def split_tax(tax):
+    return samples, taxa, matrix
 
-    r = OrderedDict()
 
-    for i in tax.split("|"):
-        level, value = i.split("__", 1)
-        if (level == "k") and (level in r):
-            continue
-        if "s" == level:
-            value = value.split(".")[0]
-        r[level] = value
+def merge_sparse(sparse, shape):
 
-    return r
+    rows, cols, values = [np.concatenate(i) for i in sparse]
+    keys, inverse = np.unique(rows * shape[1] + cols, return_inverse=True)
+    if len(keys) < len(values):
+        merged = np.zeros(len(keys))
+        np.add.at(merged, inverse, values)
+        rows, cols, values = keys // shape[1], keys % shape[1], merged
 
+    return ColumnSparse(rows, cols, values, shape)
 
-def read_tax(tax):
 
-    data = split_tax(tax)
-    index = list(data.keys())
-    r = []
+def iter_columns(matrix, samples):
+
+    '''Yield (sample, taxon ids, abundances) of the nonzero cells of each sample'''
+    if isinstance(matrix, ColumnSparse):
+        for i, sample in enumerate(samples):
+            ids, values = matrix.column(i)
+            yield sample, ids, values.astype(np.int64)
+        return
+
+    abunds = matrix.astype(np.int64)
+    for i, sample in enumerate(samples):
+        column = abunds[:, i]
+        ids = np.flatnonzero(column)
+        yield sample, ids, column[ids]
 
-    for i in  ["k", "p", "c", "o", "f", "g", "s"]:
-        if i in data:
-            r.append("%s__%s" % (i, data[i]))
-            if index[-1] == i:
-                break
-        else:
-            r.append("%s__unclassified" % i)
 
-    return r
+def resolve_taxa(taxa, server):
 
+    '''Lineage of each OTU ID, protein ids and taxids looked up in a cox1_server.py, None when unknown'''
+    ids = [i for i in taxa if "k__" not in i]
+    if not ids:
+        return taxa
+    found = {}
 
-def otu2krona(file):
+    with LookupClient(server) as client:
+        for i, value in zip(ids, client.protein(ids)):
+            if value:
+                found[i] = value[0]
+        rest = [i for i in ids if i not in found]
+        for i, tax in zip(rest, client.taxid(rest)):
+            if tax:
+                found[i] = tax
+    LOG.info("Resolved %s of %s OTU IDs that are not lineages" % (len(found), len(ids)))
 
-    samples, data = read_otu(file)
+    return [i if "k__" in i else found.get(i) for i in taxa]
 
-    for i in range(len(samples)):
-        sample = samples[i]
-        fo = open("%s.krona_report" % sample, "w")
 
-        for j in data:
-            line = data[j]
-            abund = int(line[i])
-            if abund <= 0:
-                continue
-            tax = read_tax(j)
-            fo.write("%s\t%s\n" % (abund, "\t".join(tax)))
+def write_krona(samples, taxa, matrix, mode="w", outdir="."):
+
+    table = LineageTable()
+    lineages = ["\t".join(table.read_tax(table.intern(i))) if i else None for i in taxa]
+
+    for sample, ids, abunds in iter_columns(matrix, samples):
+        keep = abunds > 0
+        fo = open(os.path.join(outdir, "%s.krona_report" % sample), mode)
+        fo.write("".join(["%s\t%s\n" % (j, lineages[i]) for i, j in zip(ids[keep], abunds[keep])
+                          if lineages[i] is not None]))
         fo.close()
 
     return 0
 
 
+def parse_size(size):
+
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
+
+def split_otu(file, parts, tmpdir, all_ids=False):
+
+    '''Hash partition the rows of the table by taxon into parts files
+
+    Every partition starts with the sample header and keeps the rows of its
+    taxa in file order, so each one can be read by read_otu on its own.
+    '''
+    names = [os.path.join(tmpdir, "part%04d.tsv" % i) for i in range(parts)]
+    handles = [open(i, "wb") for i in names]
+    header = b""
+    n = 0
+
+    for line in read_lines(file, comment=None):
+        n += 1
+        taxon = line.partition(b"\t")[0]
+        if taxon.startswith(b"#") or n == 1:
+            header = line
+            for fh in handles:
+                fh.write(line + b"\n")
+            continue
+        if b"k__" not in taxon and not all_ids:
+            continue
+        handles[zlib.crc32(taxon) % parts].write(line + b"\n")
+
+    for fh in handles:
+        fh.close()
+
+    return header, names
+
+
+def max_parts(reserve=64):
+
+    '''Partitions split_otu can hold open at once, the open file limit less a reserve'''
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft == resource.RLIM_INFINITY:
+        return MAX_PARTS
+
+    return max(1, min(MAX_PARTS, soft - reserve))
+
+
+def otu2krona_chunked(file, max_memory, mode="auto", server=None, outdir="."):
+
+    '''Out of core otu2krona, peak memory is kept around max_memory bytes
+
+    The table is hash partitioned by taxon on disk and the partitions are
+    processed one after another, appending to the krona reports. Each
+    report holds the same lines as the in-memory path, grouped by
+    partition instead of in first-row order.
+    '''
+    size = os.path.getsize(file)
+    if file.endswith(".gz"):
+        size *= 5
+    # a text cell of ~2 bytes becomes an 8 byte float plus an int copy
+    parts = max(1, int(math.ceil(size * 10.0 / max_memory)))
+    if parts > max_parts():
+        raise ValueError("--max-memory %s needs %s partitions of %s, more than the %s files that can "
+                         "be open at once; raise --max-memory" % (max_memory, parts, file, max_parts()))
+    tmpdir = tempfile.mkdtemp(prefix="otu2krona.", dir=outdir)
+    LOG.info("Splitting %s into %s partitions" % (file, parts))
+    try:
+        with stats.stage("split", nbytes=os.path.getsize(file)):
+            header, names = split_otu(file, parts, tmpdir, server is not None)
+
+        samples = [i.decode("utf-8") for i in header.partition(b"\t")[2].split(b"\t")] if header else []
+        for sample in samples:
+            open(os.path.join(outdir, "%s.krona_report" % sample), "w").close()
+        block = max(1000, max_memory // (8 * 4 * max(len(samples), 1)))
+
+        for name in names:
+            with stats.stage("read_otu", nbytes=os.path.getsize(name)) as st:
+                try:
+                    samples, taxa, matrix = read_otu(name, mode, block, server is not None)
+                except ValueError as e:
+                    raise ValueError("%s, a partition of %s" % (e, file))
+                st.records = len(taxa)
+            if server:
+                taxa = resolve_taxa(taxa, server)
+            with stats.stage("write_krona", records=len(samples)):
+                write_krona(samples, taxa, matrix, "a", outdir)
+            os.remove(name)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return 0
+
+
+def otu2krona(file, mode="auto", max_memory=None, server=None, outdir="."):
+
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if max_memory:
+        return otu2krona_chunked(file, max_memory, mode, server, outdir)
+
+    with stats.stage("read_otu", nbytes=os.path.getsize(file)) as st:
+        samples, taxa, matrix = read_otu(file, mode, all_ids=server is not None)
+        st.records = len(taxa)
+    if server:
+        with stats.stage("resolve", records=len(taxa)):
+            taxa = resolve_taxa(taxa, server)
+    stats.size("samples", samples)
+    with stats.stage("write_krona", records=len(samples)):
+        write_krona(samples, taxa, matrix, "w", outdir)
+
+    return 0
+
+
 def add_help_args(parser):
 
     parser.add_argument("input", metavar="FILE", type=str,
         help="Input annotated otu abundance table.")
+    parser.add_argument("-m", "--matrix", choices=["auto", "dense", "sparse"], default="auto",
+        help="Abundance matrix layout, auto picks sparse for tables mostly of zeros, default=auto.")
+    parser.add_argument("--max-memory", metavar="SIZE", type=str, default=None,
+        help="Process the table out of core in partitions within about SIZE of memory (e.g. 4G).")
+    parser.add_argument("--server", metavar="FILE", type=str, default=None,
+        help="Resolve OTU IDs that are protein ids or taxids with a running cox1_server.py (its Unix socket).")
+    parser.add_argument("-o", "--outdir", metavar="DIR", type=str, default=".",
+        help="Directory of the SAMPLE.krona_report files (and the --max-memory partitions), default=.")
+
+    add_stats_args(parser)
 
     return parser
 
@@ -136,6 +387,8 @@ name:
 
 attention:
      otu2krona.py meta.otu_tax.tsv
+     otu2krona.py meta.otu_tax.tsv --max-memory 8G
+     otu2krona.py meta.otu_protein.tsv --server cox1.sock
 
 version: %s
 contact:  %s <%s>\
@@ -143,7 +396,9 @@ contact:  %s <%s>\
 
     args = add_help_args(parser).parse_args()
 
-    otu2krona(args.input)
+    with instrument(args):
+        max_memory = parse_size(args.max_memory) if args.max_memory else None
+        otu2krona(args.input, args.matrix, max_memory, args.server, args.outdir)
 
 
 if __name__ == "__main__":
@@ -3,9 +3,19 @@
 
 import os
 import sys
-import gzip
+import json
+import mmap
+import struct
+import time
 import logging
 import argparse
+import tempfile
+
+from cox1db.reader import source_stat, read_tsv
+from cox1db.extsort import write_run, merge_runs
+from cox1db.writer import open_output, output_name, output_compress, add_output_args
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
 
 LOG = logging.getLogger(__name__)
 
@@ -14,25 +24,8 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "invicoun@foxmail.com"
 __all__ = []
 
-
-def read_tsv(file, sep=None):
-
-    if file.endswith(".gz"):
-        fh = gzip.open(file)
-    else:
-        fh = open(file)
-
-    for line in fh:
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
-        line = line.strip()
-
-        if not line or line.startswith("#"):
-            continue
-
-        yield line.split(sep)
-
-    fh.close()
+INDEX_MAGIC = b"P2TIDX01"
+HEADER = struct.Struct("<I")
 
 
 def read_gene_desc(file):
@@ -47,31 +40,230 @@ def read_gene_desc(file):
     return r
 
 
-def protid2taxid(desc, prot2taxid):
 
-    data = read_gene_desc(desc)
+def build_index(prot2taxid, index, buffer_size=20000000):
 
-    for line in read_tsv(prot2taxid, "\t"):
-        if line[1] in data:
-            data[line[1]][0] = line[2]
-        elif line[0] in data:
-            data[line[0]][0] = line[2]
-        else:
+    '''Build a sorted binary accession->taxid index from prot.accession2taxid.gz
+
+    The index holds two tables of fixed width records (accession padded with
+    NUL, then a little-endian uint32 taxid), one keyed by accession.version
+    and one by accession, in the order protid2taxid checks them.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix="p2t.", dir=os.path.dirname(os.path.abspath(index)))
+    tables = ["version", "accession"]
+    runs = {i: [] for i in tables}
+    buffers = {i: [] for i in tables}
+    width = 0
+    n = 0
+
+    for line in read_tsv(prot2taxid, "\t", fields=[0, 1, 2], encoding=None):
+        if not line[2].isdigit():
             continue
+        n += 1
+        buffers["version"].append((line[1], n, line[2]))
+        buffers["accession"].append((line[0], n, line[2]))
+        width = max(width, len(line[0]), len(line[1]))
+        if len(buffers["version"]) >= buffer_size:
+            for i in tables:
+                runs[i].append(write_run(buffers[i], tmpdir))
+                buffers[i] = []
+    for i in tables:
+        if buffers[i]:
+            runs[i].append(write_run(buffers[i], tmpdir))
+            buffers[i] = []
+
+    header = source_stat(prot2taxid)
+    header["source"] = os.path.abspath(prot2taxid)
+    header["width"] = width
+    record = struct.Struct("<%dsI" % width)
+    body = index + ".body"
+
+    with open(body, "wb") as fh:
+        for i in tables:
+            count = 0
+            for key, _, taxid in merge_runs(runs[i]):
+                fh.write(record.pack(key, int(taxid)))
+                count += 1
+            header[i] = count
+            for j in runs[i]:
+                os.remove(j)
+    os.rmdir(tmpdir)
+
+    header = json.dumps(header).encode("utf-8")
+    with open(index, "wb") as fo:
+        fo.write(INDEX_MAGIC)
+        fo.write(HEADER.pack(len(header)))
+        fo.write(header)
+        with open(body, "rb") as fh:
+            while True:
+                chunk = fh.read(1 << 24)
+                if not chunk:
+                    break
+                fo.write(chunk)
+    os.remove(body)
+    LOG.info("Indexed %s records of %s into %s" % (n, prot2taxid, index))
 
-    print("#protein_id\ttax_id\torganism")
+    return 0
+
+
+class AccessionIndex(object):
+
+    def __init__(self, index, prot2taxid=None):
+
+        self.fh = open(index, "rb")
+        if self.fh.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("%s is not a protid2taxid index" % index)
+        size = HEADER.unpack(self.fh.read(HEADER.size))[0]
+        self.header = json.loads(self.fh.read(size).decode("utf-8"))
+        if prot2taxid:
+            stat = source_stat(prot2taxid)
+            if stat["size"] != self.header["size"] or stat["mtime"] != self.header["mtime"]:
+                raise ValueError("Index %s is stale for %s, please rebuild it" % (index, prot2taxid))
+
+        self.width = self.header["width"]
+        self.record = struct.Struct("<%dsI" % self.width)
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(INDEX_MAGIC) + HEADER.size + size
+        self.tables = []
+        for i in ["version", "accession"]:
+            self.tables.append((start, self.header[i]))
+            start += self.header[i] * self.record.size
+
+    def search(self, table, key):
+
+        start, count = table
+        size = self.record.size
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = start + mid * size
+            if self.mm[pos:pos+self.width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos = start + lo * size
+        if lo < count and self.mm[pos:pos+self.width] == key:
+            return str(self.record.unpack_from(self.mm, pos)[1])
+
+        return None
+
+    def get(self, accession):
+
+        key = accession.encode("utf-8")
+        if len(key) > self.width:
+            return None
+        key = key.ljust(self.width, b"\0")
+        for table in self.tables:
+            taxid = self.search(table, key)
+            if taxid is not None:
+                return taxid
+
+        return None
+
+    def close(self):
+
+        self.mm.close()
+        self.fh.close()
+
+
+def scan_prot2taxid(data, prot2taxid, step=10000000):
+
+    '''Scan prot.accession2taxid and stop once every protein id is resolved
+
+    The taxid of an accession does not change between its versions, so an id
+    is closed on its first match whether by accession.version or accession.
+    '''
+    remain = set(i.encode("utf-8") for i in data)
+    start = time.time()
+    n = 0
+
+    for line in read_tsv(prot2taxid, "\t", fields=[0, 1, 2], encoding=None):
+        n += 1
+        if line[1] in remain:
+            protid = line[1]
+        elif line[0] in remain:
+            protid = line[0]
+        else:
+            protid = b""
+        if protid:
+            data[protid.decode("utf-8")][0] = line[2].decode("utf-8")
+            remain.discard(protid)
+            if not remain:
+                break
+        if n % step == 0:
+            LOG.info("Scanned %s lines, resolved %s/%s ids, %.0f lines/s" % (
+                n, len(data)-len(remain), len(data), n/max(time.time()-start, 1e-6)))
+
+    LOG.info("Scanned %s lines in %.1fs, resolved %s/%s ids" % (
+        n, time.time()-start, len(data)-len(remain), len(data)))
+
+    return set(i.decode("utf-8") for i in remain)
+
+
+def resolve_taxids(data, prot2taxid, index=None):
+
+    '''Set data[protein_id][0] to the taxid of each protein id, return the unresolved ids'''
+    if not index:
+        return scan_prot2taxid(data, prot2taxid)
+
+    idx = AccessionIndex(index, prot2taxid)
+    remain = set()
     for i in data:
-        print("%s\t%s\t%s" % (i, data[i][0], data[i][1]))
+        taxid = idx.get(i)
+        if taxid is not None:
+            data[i][0] = taxid
+        else:
+            remain.add(i)
+    idx.close()
+
+    return remain
+
+
+def protid2taxid(desc, prot2taxid, index=None, unresolved="protid2taxid.unresolved.txt",
+                 output="-", compress=None):
+
+    with stats.stage("read_desc", nbytes=os.path.getsize(desc)) as st:
+        data = read_gene_desc(desc)
+        st.records = len(data)
+    stats.size("protein_ids", data)
+    with stats.stage("resolve", nbytes=os.path.getsize(prot2taxid)) as st:
+        remain = resolve_taxids(data, prot2taxid, index)
+        st.records = len(data) - len(remain)
+
+    compress = output_compress(output, compress)
+    if unresolved:
+        unresolved = output_name(unresolved, compress)
+        with open_output(unresolved, compress) as fo:
+            for i in data:
+                if i in remain:
+                    fo.write("%s\n" % i)
+        LOG.info("Wrote %s unresolved protein ids to %s" % (len(remain), unresolved))
+
+    with stats.stage("write", records=len(data)), open_output(output, compress) as fo:
+        fo.write("#protein_id\ttax_id\torganism\n")
+        for i in data:
+            fo.write("%s\t%s\t%s\n" % (i, data[i][0], data[i][1]))
 
     return 0
 
 
 def add_help_args(parser):
 
-    parser.add_argument("input", metavar="FILE", type=str,
+    parser.add_argument("input", nargs="?", metavar="FILE", type=str,
         help="Input protein id.")
     parser.add_argument("-pt", "--prot2taxid", metavar="FILE", type=str, required=True,
         help="Input the taxid corresponding to the protein id(prot.accession2taxid.gz).")
+    parser.add_argument("-i", "--index", metavar="FILE", type=str, default=None,
+        help="Look up protein ids in the index built by --build-index.")
+    parser.add_argument("--build-index", metavar="FILE", type=str, default=None,
+        help="Build a binary index of --prot2taxid into FILE and exit.")
+    parser.add_argument("--buffer", metavar="INT", type=int, default=20000000,
+        help="Records sorted in memory per run while building the index, default=20000000.")
+    parser.add_argument("-u", "--unresolved", metavar="FILE", type=str, default="protid2taxid.unresolved.txt",
+        help="Output protein ids without a taxid, default=protid2taxid.unresolved.txt.")
+
+    add_output_args(parser)
+    add_stats_args(parser)
 
     return parser
 
@@ -92,6 +284,9 @@ name:
 
 attention:
      protid2taxid.py gene.describe.tsv -pt prot.accession2taxid.gz >gene.new_describe.tsv
+     protid2taxid.py -pt prot.accession2taxid.gz --build-index prot.accession2taxid.idx
+     protid2taxid.py gene.describe.tsv -pt prot.accession2taxid.gz -i prot.accession2taxid.idx >gene.new_describe.tsv
+     protid2taxid.py gene.describe.tsv -pt prot.accession2taxid.gz -i prot.accession2taxid.idx -o gene.new_describe.tsv.gz
 
 version: %s
 contact:  %s <%s>\
@@ -99,7 +294,14 @@ contact:  %s <%s>\
 
     args = add_help_args(parser).parse_args()
 
-    protid2taxid(args.input, args.prot2taxid)
+    with instrument(args):
+        if args.build_index:
+            build_index(args.prot2taxid, args.build_index, args.buffer)
+            return 0
+        if not args.input:
+            parser.error("the following arguments are required: FILE")
+
+        protid2taxid(args.input, args.prot2taxid, args.index, args.unresolved, args.output, args.compress)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import logging
+import argparse
+
+from cox1db.columnar import compile_cox1_taxonomy, Cox1Taxonomy
+from cox1db import stats
+from cox1db.stats import instrument, add_stats_args
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "invicoun@foxmail.com"
+__all__ = []
+
+
+def tax2columns(files, outdir=None):
+
+    for file in files:
+        col = "%s.col" % file
+        if outdir:
+            col = "%s/%s.col" % (outdir.rstrip("/"), file.split("/")[-1])
+        with stats.stage("convert", nbytes=os.path.getsize(file)) as st:
+            compile_cox1_taxonomy(file, col)
+            r = Cox1Taxonomy(col)
+            st.records = len(r)
+        LOG.info("%s: %s proteins, %s lineages, %s organisms" % (
+            col, len(r), len(r.lineages), len(r.organisms)))
+
+    return 0
+
+
+def add_help_args(parser):
+
+    parser.add_argument("input", nargs="+", metavar="FILE", type=str,
+        help="Input cox1 taxonomy tables(cox1.taxonomy.tsv.gz, cox1.seed_taxonomy.tsv.gz).")
+    parser.add_argument("-o", "--outdir", metavar="DIR", type=str, default=None,
+        help="Output directory, default next to each input (FILE.col).")
+
+    add_stats_args(parser)
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+name:
+     tax2columns.py: Convert cox1 taxonomy tables to the memory-mapped columnar form.
+
+attention:
+     tax2columns.py cox1.taxonomy.tsv.gz cox1.seed_taxonomy.tsv.gz
+     cox1_tax2krona.py cox1.taxonomy.tsv.gz --columns cox1.taxonomy.tsv.gz.col
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args = add_help_args(parser).parse_args()
+
+    with instrument(args):
+        tax2columns(args.input, args.outdir)
+
+
+if __name__ == "__main__":
+
+    main()